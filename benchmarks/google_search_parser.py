@@ -0,0 +1,139 @@
+"""
+Compares the lxml Google search result parser with the BeautifulSoup one it
+replaced, on the saved result pages in `benchmarks/fixtures/`.
+
+    python benchmarks/google_search_parser.py [--repeat=20] [--scale=1,10,50]
+
+`scale` repeats the results of each page to show how parsing time grows
+with page size.
+"""
+
+from typing import Union, Tuple
+
+import os
+import re
+import sys
+import glob
+import time
+import statistics
+
+import fire
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm_assistant_bot.utils.html_extraction import parse_google_search_results  # noqa: E402
+
+fixtures_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def legacy_parse_google_search_results(html):
+    # The parser as it was before, kept as the baseline.
+    soup = BeautifulSoup(html, 'html.parser')
+    search_results_element = soup.find(id='search')
+
+    if not search_results_element:
+        return None
+
+    link_elements = search_results_element.find_all(
+        lambda tag: (
+            tag.has_attr('href')
+            and tag['href'].startswith('http')
+            and not tag['href'].startswith(
+                'https://www.google.com/search'
+            )
+            and not tag['href'].startswith(
+                'https://translate.google.com'
+            )
+        )
+    )
+
+    def find_description(elem, max_depth=4):
+        current_depth = 0
+        parent_elem = elem
+
+        while current_depth <= max_depth:
+            parent_elem = parent_elem.parent
+            if not parent_elem:
+                break
+            if parent_elem.has_attr('lang'):
+                break
+
+        if not parent_elem:
+            return None
+
+        container_elem = parent_elem.find(
+            lambda tag: (
+                tag.has_attr('data-sncf')
+                and tag['data-sncf'].strip().startswith('1')
+                )
+            )
+        if not container_elem:
+            return None
+
+        return container_elem.text.strip()
+
+    return [
+        (elem.text, elem['href'], find_description(elem))
+        for elem in link_elements
+    ]
+
+
+def scale_results(html: str, scale: int) -> str:
+    # Repeat the content of the results list, keeping the rest of the page.
+    match = re.search(r'(<div id="rso">)(.*?)(\n\s*</div>\n\s*</div>\n\s*<div id="botstuff">)', html, re.DOTALL)
+    if not match or scale <= 1:
+        return html
+    return html[:match.start(2)] + match.group(2) * scale + html[match.end(2):]
+
+
+def measure(func, html: str, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        func(html)
+        timings.append(time.perf_counter() - started_at)
+    return statistics.median(timings)
+
+
+def main(repeat: int = 20, scale: Union[int, Tuple[int, ...]] = (1, 10, 50)):
+    scales = scale if isinstance(scale, tuple) else (scale,)
+    fixture_paths = sorted(glob.glob(os.path.join(fixtures_dir, '*.html')))
+    if not fixture_paths:
+        print(f"No fixtures found in {fixtures_dir}.")
+        return
+
+    for path in fixture_paths:
+        with open(path, 'r') as f:
+            fixture_html = f.read()
+
+        for s in scales:
+            html = scale_results(fixture_html, s)
+
+            results = parse_google_search_results(html) or []
+            legacy_results = legacy_parse_google_search_results(html) or []
+            # Descriptions may differ: the old parser could pick up the
+            # description of another result.
+            same_links = [
+                (' '.join(title.split()), url) for title, url, _ in results
+            ] == [
+                (' '.join(title.split()), url)
+                for title, url, _ in legacy_results
+            ]
+
+            legacy_time = measure(
+                legacy_parse_google_search_results, html, repeat)
+            new_time = measure(parse_google_search_results, html, repeat)
+
+            print(
+                f"{os.path.basename(path)} (x{s}, {len(html) / 1024:.0f} KiB, "
+                f"{len(results)} links): "
+                f"legacy {legacy_time * 1000:.1f} ms, "
+                f"lxml {new_time * 1000:.1f} ms, "
+                f"{legacy_time / new_time:.1f}x faster"
+                + ('' if same_links else ' (LINKS DIFFER)')
+            )
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -8,13 +8,19 @@ import langchain as langchain
 from llm_assistant_bot.initialization import initialize
 from llm_assistant_bot.config import Config as Config
 from llm_assistant_bot.db import (
-    chromadb_client as chromadb_client,
+    get_chromadb_client as get_chromadb_client,
     add_memory as add_memory,
     query_memory as query_memory,
     delete_memory as delete_memory,
     add_docs as add_docs,
     query_docs as query_docs,
     delete_docs_by_type as delete_docs_by_type,
+    delete_collection as delete_collection,
+    flush as flush,
+    embedding_cache_stats as embedding_cache_stats,
+    clear_embedding_cache as clear_embedding_cache,
+    ingest_docs as ingest_docs,
+    resync_docs as resync_docs,
 )
 
 import nest_asyncio
@@ -23,10 +29,14 @@ nest_asyncio.apply()
 
 def main(config_path: Optional[str] = None):
     initialize(config_path=config_path)
+    chromadb_client = get_chromadb_client()  # noqa: F841
 
     print("Welcome to the LLM Assistant Bot console!")
     print()
     print("query_memory, add_memory, delete_memory")
+    print("query_docs, add_docs, ingest_docs, resync_docs, delete_docs_by_type")
+    print("flush (persists pending changes of the vector store)")
+    print("embedding_cache_stats, clear_embedding_cache")
     embed(colors='neutral')
 
 
@@ -1 +1,4 @@
-from .agent import Agent as Agent
+from .agent import (
+    AgentRuntime as AgentRuntime,
+    get_agent_runtime as get_agent_runtime,
+)
@@ -1,8 +1,10 @@
-from typing import Any, Union, Callable
+from typing import Any, Union, Callable, List, Tuple
 
 import re
+import asyncio
 import logging
 import datetime
+import threading
 import pytz
 
 from langchain import BasePromptTemplate, OpenAI, LLMChain
@@ -13,12 +15,18 @@ from langchain.agents import (
 from langchain.prompts import StringPromptTemplate
 from langchain.schema import AgentAction, AgentFinish
 from langchain.memory import ConversationSummaryBufferMemory, ConversationBufferWindowMemory
-from langchain.utilities import PythonREPL
 import tiktoken
 
 from ..config import Config
-from ..db import query_memory
-from .tools.memory import get_memory_tools, get_memories_text
+from .conversation_summary_cache import get_conversation_summary_cache
+from .final_reply_stream_handler import FinalReplyStreamHandler
+from .prompt_builder import IncrementalPromptBuilder
+from .run_context import AgentRunContext, get_run_context, set_run_context, reset_run_context
+from .tools.memory import (
+    get_memory_tools,
+    aget_memories_text,
+    aget_related_context_text,
+)
 from .tools.docs import get_docs_tools
 from .tools.python_repl import get_python_repl_tool
 from .tools.web_browsing import get_browser_tools
@@ -26,19 +34,21 @@ from .tools.web_browsing import get_browser_tools
 logger = logging.getLogger("agent")
 
 
-def get_llm(model_type, model_name):
+def get_llm(model_type, model_name, streaming=False):
     if model_type == 'openai':
         if model_name in ['gpt-4', 'gpt-4-32k']:
             return ChatOpenAI(
                 model=model_name,
                 temperature=0,
                 max_tokens=Config.agent.max_generate_tokens,
+                streaming=streaming,
             )  # type: ignore
         elif model_name == 'text-davinci-003':
             return OpenAI(
                 model='text-davinci-003',
                 temperature=0,
                 max_tokens=Config.agent.max_generate_tokens,
+                streaming=streaming,
             )  # type: ignore
         else:
             raise ValueError(
@@ -67,12 +77,24 @@ def get_llm_tokenizer(model_type, model_name):
         raise ValueError(f'Invalid LLM type: {model_type}')
 
 
-class Agent():
-    def __init__(
-        self,
-        use_tool_callback: Union[Callable[[str, Any], Any], None] = None
-    ):
-        self.llm = get_llm(Config.agent.llm_type, Config.agent.llm_model_name)
+class AgentRuntime():
+    """
+    Holds the objects that are expensive to build (LLM clients, tokenizer,
+    tools, prompt template and the agent itself). A single instance is shared
+    by all concurrent agent runs, while per-run state lives in an
+    `AgentRunContext`.
+    """
+
+    def __init__(self):
+        self.llm = get_llm(
+            Config.agent.llm_type,
+            Config.agent.llm_model_name,
+            streaming=Config.agent.stream_final_reply,
+        )
+        self.conversation_memory_llm = get_llm(
+            Config.agent.conversation_memory_llm_type,
+            Config.agent.conversation_memory_llm_model_name,
+        )
         self.llm_max_token_limit = get_llm_max_token_limit(
             Config.agent.llm_type, Config.agent.llm_model_name
         )
@@ -83,7 +105,7 @@ class Agent():
         tokenizer = self.tokenizer
 
         # Setup tools
-        browser_tools = get_browser_tools()
+        browser_tools = get_browser_tools(tokenizer=tokenizer)
         python_repl_tool = get_python_repl_tool()
 
         self.tools = [
@@ -92,72 +114,96 @@ class Agent():
             python_repl_tool,
         ] + browser_tools
         self.tool_names = [tool.name for tool in self.tools]
-        self.use_tool_callback = use_tool_callback
 
         tools = self.tools
-        use_tool_callback = self.use_tool_callback
+        tools_text = "\n".join(
+            [f"{tool.name}: {tool.description}" for tool in tools])
+        tool_names_text = ", ".join([tool.name for tool in tools])
 
-        # Setup prompt template
-        class PromptTemplate(StringPromptTemplate):
-            def format(self, **kwargs) -> str:
-                prompt_template = Config.agent.prompt_template
+        # Number of memory queries (each an embedding request plus a vector
+        # search) saved by computing the prompt context once per run.
+        self.memory_queries_avoided = 0
 
-                timezone = pytz.timezone(Config.timezone)
-                local_time = datetime.datetime.now(timezone)
-                date_str = local_time.strftime('%Y-%m-%d')
+        def get_prompt_context(memories_text, **kwargs):
+            timezone = pytz.timezone(Config.timezone)
+            local_time = datetime.datetime.now(timezone)
+            date_str = local_time.strftime('%Y-%m-%d')
 
-                # Get the intermediate steps (AgentAction, Observation tuples)
-                # Format them in a particular way
-                intermediate_steps = kwargs.pop("intermediate_steps")
-                intermediate_steps_len = len(intermediate_steps)
-                thoughts = ""
-                for i, (action, observation) in enumerate(intermediate_steps):
-                    thoughts += action.log
-                    if i < intermediate_steps_len - 1:
-                        tokenized_observation = tokenizer.encode(observation)
-                        if len(tokenized_observation) > Config.agent.old_observation_max_token_limit:
-                            observation = tokenizer.decode(tokenized_observation[:Config.agent.old_observation_max_token_limit]) + \
-                                '\n  ... (observation content truncated)'
-                    thoughts += f"\nObservation: {observation}\nThought: "
-                # Set the agent_scratchpad variable to that value
-                kwargs["agent_scratchpad"] = thoughts
+            kwargs = {
+                **kwargs,
                 # Create a tools variable from the list of tools provided
-                kwargs["tools"] = "\n".join(
-                    [f"{tool.name}: {tool.description}" for tool in tools])
+                'tools': tools_text,
                 # Create a list of tool names for the tools provided
-                kwargs["tool_names"] = ", ".join([tool.name for tool in tools])
-
-                kwargs["current_date"] = date_str
-                kwargs["knowledge_cutoff_date"] = '2021-01-01'
-                kwargs["timezone"] = Config.timezone
-
-                kwargs['memories'] = get_memories_text(
-                    kwargs['input'],
-                    tokenizer=tokenizer,
-                )
+                'tool_names': tool_names_text,
+                'current_date': date_str,
+                'knowledge_cutoff_date': '2021-01-01',
+                'timezone': Config.timezone,
+            }
+
+            kwargs['memories'] = memories_text
+
+            if not kwargs['memories']:
+                kwargs['memories'] = ''
+            elif Config.agent.memories_template:
+                kwargs['memories'] = \
+                    Config.agent.memories_template.format(**kwargs) + '\n'
+
+            if not kwargs.get('history'):
+                kwargs['history'] = ''
+            elif Config.agent.history_template:
+                kwargs['history'] = \
+                    Config.agent.history_template.format(**kwargs) + '\n'
+
+            kwargs['pre_taken_actions'] = \
+                kwargs['memories']
+
+            if kwargs['pre_taken_actions'] and Config.agent.pre_taken_actions_template:
+                kwargs['pre_taken_actions'] = \
+                    Config.agent.pre_taken_actions_template.format(**kwargs) + '\n'
 
-                if not kwargs['memories']:
-                    kwargs['memories'] = ''
-                elif Config.agent.memories_template:
-                    kwargs['memories'] = \
-                        Config.agent.memories_template.format(**kwargs) + '\n'
+            return kwargs
 
-                if not kwargs.get('history'):
-                    kwargs['history'] = ''
-                elif Config.agent.history_template:
-                    kwargs['history'] = \
-                        Config.agent.history_template.format(**kwargs) + '\n'
+        runtime = self
 
-                kwargs['pre_taken_actions'] = \
-                    kwargs['memories']
+        # Setup prompt template
+        class PromptTemplate(StringPromptTemplate):
+            def format(self, **kwargs) -> str:
+                prompt_template = Config.agent.prompt_template
 
-                if kwargs['pre_taken_actions'] and Config.agent.pre_taken_actions_template:
-                    kwargs['pre_taken_actions'] = \
-                        Config.agent.pre_taken_actions_template.format(**kwargs) + '\n'
+                # Memories, tools, date and history do not change during a
+                # run, so only compute them on the first step.
+                run_context = get_run_context()
+                prompt_context = run_context.prompt_context
+                if (
+                    prompt_context is None
+                    or prompt_context['input'] != kwargs['input']
+                ):
+                    # Retrieving memories here would block the event loop,
+                    # they are retrieved asynchronously by `arun`.
+                    prefetched = run_context.prefetched_memories_text
+                    if prefetched is None or prefetched[0] != kwargs['input']:
+                        raise RuntimeError(
+                            'Memories for the input have not been retrieved, '
+                            'the agent must be run with `AgentRuntime.arun`.')
+                    memories_text = prefetched[1]
+                    prompt_context = get_prompt_context(
+                        memories_text=memories_text, **kwargs)
+                    run_context.prompt_context = prompt_context
+                    run_context.prompt_builder = IncrementalPromptBuilder(
+                        tokenizer=tokenizer,
+                        prompt_template=prompt_template,
+                        prompt_context=prompt_context,
+                        old_observation_max_token_limit=Config.agent.old_observation_max_token_limit,
+                    )
+                else:
+                    runtime.memory_queries_avoided += 1
 
-                prompt = prompt_template.format(**kwargs)
+                # Get the intermediate steps (AgentAction, Observation tuples)
+                # and format them, only tokenizing the newly added ones.
+                intermediate_steps = kwargs.pop("intermediate_steps")
+                prompt, tokenized_prompt, agent_scratchpad = \
+                    run_context.prompt_builder.build(intermediate_steps)
 
-                tokenized_prompt = tokenizer.encode(prompt)
                 token_limit = llm_max_token_limit - (Config.agent.max_generate_tokens + 20)
                 prompt_truncated = False
                 if len(tokenized_prompt) > token_limit:
@@ -172,7 +218,7 @@ class Agent():
                 else:
                     logger.info(f"Prompt length: {len(tokenized_prompt)} tokens")
 
-                if kwargs.get('agent_scratchpad'):
+                if agent_scratchpad:
                     logger.debug(
                         f"Current prompt:\n---- BEGIN OF PROMPT ----\n{prompt}\n---- END OF PROMPT ----")
                 else:
@@ -214,6 +260,7 @@ class Agent():
                 action_input = match.group(2) or ''
 
                 tool_input = action_input.strip(" ").strip('"')
+                use_tool_callback = get_run_context().use_tool_callback
                 if use_tool_callback:
                     use_tool_callback(action, tool_input)
 
@@ -238,22 +285,119 @@ class Agent():
             allowed_tools=self.tool_names,  # type: ignore
         )
 
-    def get_agent_executor(self, memory: ConversationSummaryBufferMemory):
+    def get_agent_executor(self):
+        # No memory is attached: the history is passed as an input, since
+        # saving the reply to the memory would run a summarization on the
+        # event loop, and the memory is rebuilt from the thread on each run
+        # anyway.
         agent_executor = AgentExecutor.from_agent_and_tools(
             agent=self.agent,
             tools=self.tools,
             verbose=True,
-            memory=memory,
             max_execution_time=Config.agent.max_execution_time,
         )
         return agent_executor
 
     def get_new_memory(self):
-        llm = get_llm(
-            Config.agent.conversation_memory_llm_type,
-            Config.agent.conversation_memory_llm_model_name,
-        )
         return ConversationSummaryBufferMemory(
-            llm=llm,
+            llm=self.conversation_memory_llm,
             max_token_limit=Config.agent.conversation_memory_max_token_limit,
         )
+
+    async def abuild_memory(
+        self,
+        messages: List[Tuple[str, str, str]],
+        conversation_key: Union[str, None] = None,
+    ) -> ConversationSummaryBufferMemory:
+        """
+        Builds the conversation memory from `messages`, a list of
+        `(ts, role, text)` tuples in chronological order where role is
+        'human' or 'ai'.
+
+        If `conversation_key` is given, the summary of messages that have
+        overflowed the memory is cached, and only messages after the last
+        summarized one are summarized on the next call. Summarization runs
+        off the event loop.
+        """
+        memory = self.get_new_memory()
+
+        cache = get_conversation_summary_cache() if conversation_key else None
+        cached = cache.get(conversation_key) if cache else None  # type: ignore
+        if cached:
+            summary, last_summarized_ts = cached
+            memory.moving_summary_buffer = summary
+            messages = [
+                m for m in messages
+                if float(m[0]) > float(last_summarized_ts)
+            ]
+
+        for _, role, text in messages:
+            if role == 'ai':
+                memory.chat_memory.add_ai_message(text)
+            else:
+                memory.chat_memory.add_user_message(text)
+
+        messages_count = len(memory.chat_memory.messages)
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, memory.prune)
+        pruned_count = messages_count - len(memory.chat_memory.messages)
+
+        if cache and pruned_count > 0:
+            cache.set(
+                conversation_key,  # type: ignore
+                memory.moving_summary_buffer,
+                messages[pruned_count - 1][0],
+            )
+
+        return memory
+
+    async def arun(
+        self,
+        input: str,
+        memory: ConversationSummaryBufferMemory,
+        use_tool_callback: Union[Callable[[str, Any], Any], None] = None,
+        final_reply_callback: Union[Callable[[str], Any], None] = None,
+    ) -> str:
+        """
+        Runs the agent on `input`. If `final_reply_callback` is given and
+        `agent.stream_final_reply` is enabled, it is called with the partial
+        final reply as it is being generated.
+        """
+        callbacks = None
+        if final_reply_callback and Config.agent.stream_final_reply:
+            callbacks = [FinalReplyStreamHandler(final_reply_callback)]
+
+        run_context = AgentRunContext(use_tool_callback=use_tool_callback)
+        token = set_run_context(run_context)
+        try:
+            # Retrieve memories without blocking the event loop, the prompt
+            # template (which is sync) will pick them up.
+            if Config.agent.auto_retrieve_docs:
+                memories_text = await aget_related_context_text(
+                    input, tokenizer=self.tokenizer)
+            else:
+                memories_text = await aget_memories_text(
+                    input, tokenizer=self.tokenizer)
+            run_context.prefetched_memories_text = (input, memories_text)
+            history = memory.load_memory_variables({})[memory.memory_key]
+            agent_executor = self.get_agent_executor()
+            return await agent_executor.arun(
+                input=input, history=history, callbacks=callbacks)
+        finally:
+            reset_run_context(token)
+            await run_context.aclose()
+            logger.info(
+                f"Memory queries avoided so far: {self.memory_queries_avoided}")
+
+
+_agent_runtime: Union[AgentRuntime, None] = None
+_agent_runtime_lock = threading.Lock()
+
+
+def get_agent_runtime() -> AgentRuntime:
+    global _agent_runtime
+    if _agent_runtime is None:
+        with _agent_runtime_lock:
+            if _agent_runtime is None:
+                _agent_runtime = AgentRuntime()
+    return _agent_runtime
@@ -0,0 +1,85 @@
+from typing import Tuple, Union
+
+import os
+import time
+import sqlite3
+import threading
+
+from ..config import Config
+
+
+class ConversationSummaryCache():
+    """
+    Stores the running summary of each conversation, together with the
+    timestamp of the last message that has been folded into it, so that the
+    summary can be extended with only the messages that overflowed since.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+        dir_path = os.path.dirname(path)
+        if dir_path:
+            os.makedirs(dir_path, exist_ok=True)
+        self._conn = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS conversation_summaries (
+                conversation_key TEXT PRIMARY KEY,
+                summary TEXT NOT NULL,
+                last_summarized_ts TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+
+    def get(self, conversation_key: str) -> Union[Tuple[str, str], None]:
+        """
+        Returns `(summary, last_summarized_ts)`, or None if the conversation
+        has no summary yet.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT summary, last_summarized_ts '
+                'FROM conversation_summaries WHERE conversation_key = ?',
+                (conversation_key,),
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1]
+
+    def set(
+        self, conversation_key: str, summary: str, last_summarized_ts: str
+    ):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO conversation_summaries '
+                '(conversation_key, summary, last_summarized_ts, updated_at) '
+                'VALUES (?, ?, ?, ?)',
+                (conversation_key, summary, last_summarized_ts, time.time()),
+            )
+
+    def delete(self, conversation_key: str):
+        with self._lock:
+            self._conn.execute(
+                'DELETE FROM conversation_summaries '
+                'WHERE conversation_key = ?',
+                (conversation_key,),
+            )
+
+
+_conversation_summary_cache: Union[ConversationSummaryCache, None] = None
+_conversation_summary_cache_lock = threading.Lock()
+
+
+def get_conversation_summary_cache() -> Union[ConversationSummaryCache, None]:
+    global _conversation_summary_cache
+    if not Config.agent.conversation_summary_cache_enabled:
+        return None
+    if _conversation_summary_cache is None:
+        with _conversation_summary_cache_lock:
+            if _conversation_summary_cache is None:
+                _conversation_summary_cache = ConversationSummaryCache(
+                    Config.agent.conversation_summary_cache_path)
+    return _conversation_summary_cache
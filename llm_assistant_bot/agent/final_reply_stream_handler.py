@@ -0,0 +1,51 @@
+from typing import Any, Callable
+
+from langchain.callbacks.base import AsyncCallbackHandler
+
+FINAL_REPLY_PREFIX = 'Final Reply:'
+
+
+class FinalReplyStreamHandler(AsyncCallbackHandler):
+    """
+    Watches the tokens streamed by the LLM and, once an LLM call has written
+    `Final Reply:`, calls `on_final_reply` with the partial reply so far on
+    every new token. Thoughts and actions before that are never passed on.
+    """
+
+    def __init__(self, on_final_reply: Callable[[str], Any]):
+        self.on_final_reply = on_final_reply
+        self._text = ''
+        self._reply_start = -1
+
+    async def on_llm_start(self, *args: Any, **kwargs: Any) -> None:
+        self._reset()
+
+    async def on_chat_model_start(self, *args: Any, **kwargs: Any) -> None:
+        self._reset()
+
+    async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        self._text += token
+
+        # Only the last "Final Reply:" counts, the same as in the output
+        # parser.
+        search_from = max(self._reply_start, 0)
+        index = self._text.find(FINAL_REPLY_PREFIX, search_from)
+        while index >= 0:
+            self._reply_start = index + len(FINAL_REPLY_PREFIX)
+            index = self._text.find(FINAL_REPLY_PREFIX, self._reply_start)
+        if self._reply_start < 0:
+            return
+
+        partial_reply = self._text[self._reply_start:].strip()
+        if partial_reply:
+            self.on_final_reply(partial_reply)
+
+    async def on_llm_end(self, *args: Any, **kwargs: Any) -> None:
+        self._reset()
+
+    async def on_llm_error(self, *args: Any, **kwargs: Any) -> None:
+        self._reset()
+
+    def _reset(self):
+        self._text = ''
+        self._reply_start = -1
@@ -0,0 +1,123 @@
+from typing import Any, Dict, List, Tuple
+
+from langchain.schema import AgentAction
+
+SCRATCHPAD_PLACEHOLDER = '\x00agent_scratchpad\x00'
+OBSERVATION_PREFIX = '\nObservation: '
+OBSERVATION_SUFFIX = '\nThought: '
+OBSERVATION_TRUNCATED_SUFFIX = '\n  ... (observation content truncated)'
+
+
+class _Step():
+    def __init__(self, action: AgentAction, observation: str, tokenizer,
+                 old_observation_max_token_limit: int):
+        self.action = action
+
+        self.log = action.log
+        self.log_tokens = tokenizer.encode(self.log)
+
+        self.observation = observation
+        self.observation_tokens = tokenizer.encode(observation)
+
+        # The version shown once this step is no longer the latest one.
+        if len(self.observation_tokens) > old_observation_max_token_limit:
+            truncated_tokens = \
+                self.observation_tokens[:old_observation_max_token_limit]
+            self.old_observation = tokenizer.decode(truncated_tokens) + \
+                OBSERVATION_TRUNCATED_SUFFIX
+            self.old_observation_tokens = truncated_tokens + \
+                tokenizer.encode(OBSERVATION_TRUNCATED_SUFFIX)
+        else:
+            self.old_observation = self.observation
+            self.old_observation_tokens = self.observation_tokens
+
+
+class IncrementalPromptBuilder():
+    """
+    Builds the prompt of each agent step from cached per-segment token
+    arrays. The parts of the prompt around the scratchpad are encoded once
+    per run, and each action/observation is encoded once when it is
+    appended, so a step only pays for tokenizing the new content.
+
+    Token counts are the sum of the segments' counts, which can differ by a
+    few tokens from encoding the whole prompt at once. Decoding the joined
+    tokens always gives back the exact prompt text.
+    """
+
+    def __init__(
+        self,
+        tokenizer,
+        prompt_template: str,
+        prompt_context: Dict[str, Any],
+        old_observation_max_token_limit: int,
+    ):
+        self.tokenizer = tokenizer
+        self.old_observation_max_token_limit = old_observation_max_token_limit
+
+        rendered = prompt_template.format(
+            **{**prompt_context, 'agent_scratchpad': SCRATCHPAD_PLACEHOLDER}
+        )
+        parts = rendered.split(SCRATCHPAD_PLACEHOLDER)
+        # Every occurrence of `{agent_scratchpad}` gets the same content.
+        self.static_parts = parts
+        self.static_parts_tokens = [tokenizer.encode(p) for p in parts]
+
+        self.observation_prefix_tokens = tokenizer.encode(OBSERVATION_PREFIX)
+        self.observation_suffix_tokens = tokenizer.encode(OBSERVATION_SUFFIX)
+
+        self.steps: List[_Step] = []
+
+    def _sync_steps(self, intermediate_steps: List[Tuple[AgentAction, str]]):
+        # Drop the cache if the steps are not a continuation of what has
+        # been seen, which should not happen within a run.
+        for i, step in enumerate(self.steps):
+            if (
+                i >= len(intermediate_steps)
+                or intermediate_steps[i][0] is not step.action
+                or intermediate_steps[i][1] != step.observation
+            ):
+                self.steps = self.steps[:i]
+                break
+
+        for action, observation in intermediate_steps[len(self.steps):]:
+            self.steps.append(_Step(
+                action, observation,
+                tokenizer=self.tokenizer,
+                old_observation_max_token_limit=self.old_observation_max_token_limit,
+            ))
+
+    def build(
+        self,
+        intermediate_steps: List[Tuple[AgentAction, str]],
+    ) -> Tuple[str, List[int], str]:
+        """
+        Returns the prompt, its tokens, and the scratchpad text.
+        """
+        self._sync_steps(intermediate_steps)
+
+        scratchpad_parts = []
+        scratchpad_tokens: List[int] = []
+        steps_len = len(self.steps)
+        for i, step in enumerate(self.steps):
+            if i < steps_len - 1:
+                observation = step.old_observation
+                observation_tokens = step.old_observation_tokens
+            else:
+                observation = step.observation
+                observation_tokens = step.observation_tokens
+            scratchpad_parts += [
+                step.log, OBSERVATION_PREFIX, observation, OBSERVATION_SUFFIX]
+            scratchpad_tokens += step.log_tokens
+            scratchpad_tokens += self.observation_prefix_tokens
+            scratchpad_tokens += observation_tokens
+            scratchpad_tokens += self.observation_suffix_tokens
+        scratchpad = ''.join(scratchpad_parts)
+
+        tokens = list(self.static_parts_tokens[0])
+        for part_tokens in self.static_parts_tokens[1:]:
+            tokens += scratchpad_tokens
+            tokens += part_tokens
+
+        prompt = scratchpad.join(self.static_parts)
+
+        return prompt, tokens, scratchpad
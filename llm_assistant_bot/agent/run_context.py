@@ -0,0 +1,69 @@
+from typing import Any, Union, Callable, Dict, Tuple
+
+import contextlib
+import contextvars
+
+from langchain.utilities import PythonREPL
+
+
+class AgentRunContext():
+    """
+    Holds the state that belongs to a single agent run, so that the heavy
+    objects in `AgentRuntime` can be shared by concurrent runs.
+    """
+
+    def __init__(
+        self,
+        use_tool_callback: Union[Callable[[str, Any], Any], None] = None
+    ):
+        self.use_tool_callback = use_tool_callback
+        self._python_repl = None
+
+        # Prompt variables that stay the same during the run, computed on
+        # the first step.
+        self.prompt_context: Union[Dict[str, Any], None] = None
+        # (input, memories text) retrieved asynchronously before the run.
+        self.prefetched_memories_text: Union[Tuple[str, str], None] = None
+        # An `IncrementalPromptBuilder` for the run.
+        self.prompt_builder: Any = None
+
+        # The browser page leased for this run, see `get_run_page`.
+        self.browser_page: Any = None
+
+        # Resources leased during the run that should be released when the
+        # run ends.
+        self.exit_stack = contextlib.AsyncExitStack()
+
+    @property
+    def python_repl(self) -> PythonREPL:
+        # Each run gets its own REPL globals, so variables defined by one
+        # conversation never leak into another.
+        if self._python_repl is None:
+            self._python_repl = PythonREPL()
+        return self._python_repl
+
+    async def aclose(self):
+        self.browser_page = None
+        await self.exit_stack.aclose()
+
+
+_current_run_context: contextvars.ContextVar[Union[AgentRunContext, None]] = \
+    contextvars.ContextVar('agent_run_context', default=None)
+
+
+def get_run_context() -> AgentRunContext:
+    run_context = _current_run_context.get()
+    if run_context is None:
+        # Tools used outside of `AgentRuntime.arun` (e.g. in the console)
+        # get a context of their own.
+        run_context = AgentRunContext()
+        _current_run_context.set(run_context)
+    return run_context
+
+
+def set_run_context(run_context: AgentRunContext) -> contextvars.Token:
+    return _current_run_context.set(run_context)
+
+
+def reset_run_context(token: contextvars.Token):
+    _current_run_context.reset(token)
@@ -0,0 +1,269 @@
+from typing import Union, List, Tuple, AsyncIterator
+
+import weakref
+import asyncio
+import logging
+import functools
+import contextlib
+from urllib.parse import urlsplit
+
+from playwright.async_api import (
+    async_playwright,
+    Playwright,
+    Browser,
+    BrowserContext,
+    Page,
+    Route,
+    Request,
+    Response,
+    TimeoutError as PlaywrightTimeoutError,
+)
+
+from ...config import Config
+
+logger = logging.getLogger("browser_manager")
+
+
+class PageLeaseTimeoutError(Exception):
+    pass
+
+
+class _NavigationBudget():
+    def __init__(self):
+        self.bytes_loaded = 0
+
+    async def on_request_finished(self, request: Request):
+        # Count the bytes actually received, since chunked and compressed
+        # responses often have no `Content-Length`. Fall back to the header
+        # if the sizes are not available.
+        size = -1
+        with contextlib.suppress(Exception):
+            size = (await request.sizes())['responseBodySize']
+        if size < 0:
+            size = 0
+            with contextlib.suppress(Exception):
+                response = await request.response()
+                content_length = response.headers.get('content-length', '') \
+                    if response else ''
+                if content_length.isdigit():
+                    size = int(content_length)
+        self.bytes_loaded += size
+
+
+def is_blocked_domain(url: str) -> bool:
+    host = urlsplit(url).hostname or ''
+    return any(
+        host == domain or host.endswith('.' + domain)
+        for domain in Config.browser.blocked_domains
+    )
+
+
+class BrowserManager():
+    """
+    Owns a long-lived Chromium instance and a bounded pool of pages, each
+    in its own browser context. Pages are leased by agent runs and recycled
+    afterwards.
+
+    Requests of the pages for blocked resource types and domains are
+    aborted, and `goto` limits the time and bytes spent on a navigation.
+    """
+
+    def __init__(self):
+        self._playwright: Union[Playwright, None] = None
+        self._browser: Union[Browser, None] = None
+        self._idle_pages: List[Tuple[BrowserContext, Page]] = []
+        self._semaphore: Union[asyncio.Semaphore, None] = None
+        self._launch_lock: Union[asyncio.Lock, None] = None
+        self._health_check_task: Union[asyncio.Task, None] = None
+        self._budgets: 'weakref.WeakKeyDictionary[Page, _NavigationBudget]' = \
+            weakref.WeakKeyDictionary()
+
+    async def start(self):
+        await self._ensure_browser()
+        while len(self._idle_pages) < Config.browser.warm_up_pages:
+            self._idle_pages.append(await self._new_page())
+        logger.info(
+            f"Browser started with {len(self._idle_pages)} warm page(s).")
+
+        if (
+            self._health_check_task is None
+            and Config.browser.health_check_interval > 0
+        ):
+            self._health_check_task = asyncio.create_task(
+                self._health_check_loop()
+            )
+
+    async def close(self):
+        if self._health_check_task:
+            self._health_check_task.cancel()
+            self._health_check_task = None
+        self._idle_pages = []
+        if self._browser:
+            with contextlib.suppress(Exception):
+                await self._browser.close()
+            self._browser = None
+        if self._playwright:
+            with contextlib.suppress(Exception):
+                await self._playwright.stop()
+            self._playwright = None
+
+    @contextlib.asynccontextmanager
+    async def lease_page(self) -> AsyncIterator[Page]:
+        semaphore = self._get_semaphore()
+        if semaphore.locked():
+            logger.info("All browser pages are in use, waiting for one.")
+        try:
+            await asyncio.wait_for(
+                semaphore.acquire(),
+                timeout=Config.browser.page_lease_timeout,
+            )
+        except asyncio.TimeoutError:
+            # Raised as a distinct error, so that it is not taken for a
+            # timeout of the whole agent run.
+            raise PageLeaseTimeoutError(
+                f"No browser page available within "
+                f"{Config.browser.page_lease_timeout} seconds") from None
+        try:
+            context, page = await self._take_idle_page()
+            try:
+                yield page
+            finally:
+                await self._recycle_page(context, page)
+        finally:
+            semaphore.release()
+
+    async def goto(self, page: Page, url: str) -> Union[Response, None]:
+        """
+        Navigates `page` to `url` within the navigation budgets. Returns None
+        if the time budget ran out, in which case the page is left with
+        whatever has been loaded so far.
+        """
+        budget = self._budgets.get(page)
+        if budget:
+            budget.bytes_loaded = 0
+        try:
+            return await page.goto(
+                url,
+                wait_until=Config.browser.navigation_wait_until,  # type: ignore
+                timeout=Config.browser.navigation_timeout * 1000,
+            )
+        except PlaywrightTimeoutError:
+            logger.info(
+                f"Loading '{url}' took longer than "
+                f"{Config.browser.navigation_timeout}s, using what has been "
+                "loaded.")
+            with contextlib.suppress(Exception):
+                await page.evaluate('window.stop()')
+            return None
+
+    async def health_check(self):
+        if self._browser and self._browser.is_connected():
+            return
+        logger.warning("Browser is not connected, restarting it.")
+        await self._restart_browser()
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(Config.browser.max_pages)
+        return self._semaphore
+
+    def _get_launch_lock(self) -> asyncio.Lock:
+        if self._launch_lock is None:
+            self._launch_lock = asyncio.Lock()
+        return self._launch_lock
+
+    async def _ensure_browser(self) -> Browser:
+        async with self._get_launch_lock():
+            if self._browser and self._browser.is_connected():
+                return self._browser
+
+            if self._playwright is None:
+                self._playwright = await async_playwright().start()
+            self._browser = await self._playwright.chromium.launch(
+                headless=Config.browser.headless,
+            )
+            # Pages of a dead browser are useless.
+            self._idle_pages = []
+            return self._browser
+
+    async def _restart_browser(self):
+        browser = self._browser
+        self._browser = None
+        self._idle_pages = []
+        if browser:
+            with contextlib.suppress(Exception):
+                await browser.close()
+        await self._ensure_browser()
+
+    async def _new_page(self) -> Tuple[BrowserContext, Page]:
+        browser = await self._ensure_browser()
+        context = await browser.new_context()
+        budget = _NavigationBudget()
+        await context.route(
+            '**/*', functools.partial(self._route_request, budget))
+        context.on('requestfinished', budget.on_request_finished)
+        page = await context.new_page()
+        self._budgets[page] = budget
+        return context, page
+
+    async def _route_request(
+        self, budget: _NavigationBudget, route: Route, request: Request
+    ):
+        reason: Union[str, None] = None
+        if request.resource_type in Config.browser.blocked_resource_types:
+            reason = 'resource type'
+        elif is_blocked_domain(request.url):
+            reason = 'domain'
+        elif (
+            budget.bytes_loaded > Config.browser.navigation_max_bytes
+            and not request.is_navigation_request()
+        ):
+            reason = 'byte budget'
+
+        if reason:
+            logger.debug(f"Blocked request ({reason}): {request.url}")
+            await route.abort('blockedbyclient')
+        else:
+            await route.continue_()
+
+    async def _take_idle_page(self) -> Tuple[BrowserContext, Page]:
+        while self._idle_pages:
+            context, page = self._idle_pages.pop()
+            if not page.is_closed() and self._browser \
+                    and self._browser.is_connected():
+                return context, page
+        return await self._new_page()
+
+    async def _recycle_page(self, context: BrowserContext, page: Page):
+        try:
+            if page.is_closed() or not (
+                self._browser and self._browser.is_connected()
+            ):
+                raise RuntimeError('page is no longer usable')
+            # Do not let cookies or the last visited page leak into the next
+            # agent run.
+            await context.clear_cookies()
+            await page.goto('about:blank')
+            self._idle_pages.append((context, page))
+        except Exception as e:
+            logger.debug(f"Discarding browser page: {e}")
+            with contextlib.suppress(Exception):
+                await context.close()
+
+    async def _health_check_loop(self):
+        while True:
+            await asyncio.sleep(Config.browser.health_check_interval)
+            try:
+                await self.health_check()
+            except Exception as e:
+                logger.error(f"Browser health check failed: {e}")
+
+
+_browser_manager: Union[BrowserManager, None] = None
+
+
+def get_browser_manager() -> BrowserManager:
+    global _browser_manager
+    if _browser_manager is None:
+        _browser_manager = BrowserManager()
+    return _browser_manager
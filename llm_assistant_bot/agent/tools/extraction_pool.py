@@ -0,0 +1,115 @@
+from typing import Any, Callable, TypeVar, Union
+
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from ...config import Config
+
+logger = logging.getLogger("extraction_pool")
+
+T = TypeVar('T')
+
+
+class ExtractionTimeoutError(Exception):
+    pass
+
+
+class ExtractionPool():
+    """
+    Runs CPU-heavy HTML processing (readability, markdownify, lxml)
+    in worker processes, so that it does not block the event loop. Input
+    HTML is truncated to `max_html_length`, and a task that takes longer
+    than `timeout` seconds gets its worker processes killed.
+    """
+
+    def __init__(self, max_workers: int, timeout: int, max_html_length: int):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.max_html_length = max_html_length
+        self._executor: Union[ProcessPoolExecutor, None] = None
+
+    async def run(self, func: Callable[[str], T], html: str) -> T:
+        """
+        Runs `func(html)` in a worker process. `func` must be a module-level
+        function, such as those in `utils.html_extraction`.
+        """
+        if len(html) > self.max_html_length:
+            logger.info(
+                f"Truncating HTML of {len(html)} characters to "
+                f"{self.max_html_length} for extraction.")
+            html = html[:self.max_html_length]
+
+        loop = asyncio.get_event_loop()
+        retried = False
+        while True:
+            executor = self._get_executor()
+            try:
+                return await asyncio.wait_for(
+                    loop.run_in_executor(executor, func, html),
+                    timeout=self.timeout,
+                )
+            except asyncio.TimeoutError:
+                # A running task can not be cancelled, so kill the workers
+                # to get them back.
+                logger.warning(
+                    f"{func.__name__} timed out after {self.timeout}s, "
+                    "restarting the extraction workers.")
+                self._recycle(executor)
+                raise ExtractionTimeoutError(
+                    f"extracting the page content timed out "
+                    f"(> {self.timeout} seconds)")
+            except BrokenProcessPool:
+                # Another task's timeout took the workers down, retry once
+                # on the new ones.
+                self._recycle(executor)
+                if retried:
+                    raise
+                retried = True
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # Workers are forked from a fork server rather than from the bot,
+            # which by now runs threads (whose locks a forked child could
+            # inherit held) and holds sockets and database files. Workers
+            # still import the main module, which does not open the vector
+            # store or start any threads.
+            context = multiprocessing.get_context('forkserver')
+            context.set_forkserver_preload([
+                'llm_assistant_bot.utils.html_extraction',
+            ])
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=context,
+            )
+        return self._executor
+
+    def _recycle(self, executor: ProcessPoolExecutor):
+        if self._executor is not executor:
+            return
+        self._executor = None
+        processes: Any = getattr(executor, '_processes', None) or {}
+        for process in list(processes.values()):
+            process.kill()
+        executor.shutdown(wait=False)
+
+
+_extraction_pool: Union[ExtractionPool, None] = None
+
+
+def get_extraction_pool() -> ExtractionPool:
+    global _extraction_pool
+    if _extraction_pool is None:
+        _extraction_pool = ExtractionPool(
+            max_workers=Config.browser.extraction_workers,
+            timeout=Config.browser.extraction_timeout,
+            max_html_length=Config.browser.extraction_max_html_length,
+        )
+    return _extraction_pool
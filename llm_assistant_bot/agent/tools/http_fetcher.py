@@ -0,0 +1,111 @@
+from typing import Dict, Union
+
+import re
+import asyncio
+import logging
+
+import aiohttp
+
+from ...config import Config
+
+logger = logging.getLogger("http_fetcher")
+
+_JS_REQUIRED_PATTERN = re.compile(
+    r'<noscript[^>]*>[^<]{0,200}'
+    r'(enable|turn on|requires?|need)[^<]{0,40}javascript',
+    re.IGNORECASE,
+)
+
+
+class HttpFetchResult():
+    def __init__(self, url: str, status: int, headers: Dict[str, str], html: str):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.html = html
+
+
+def needs_browser(html: str, content: str) -> bool:
+    """
+    Whether the content extracted from a plain HTTP response is too thin to
+    be the real page, e.g. because the page is rendered by JavaScript.
+    """
+    if len(content.strip()) < Config.browser.http_fetch_min_content_length:
+        return True
+    return bool(_JS_REQUIRED_PATTERN.search(html))
+
+
+class HttpFetcher():
+    """
+    Fetches pages with a pooled HTTP client, as a fast path before loading
+    them in the browser. Only successful HTML responses are returned, for
+    anything else the caller should use the browser.
+    """
+
+    def __init__(self):
+        self._session: Union[aiohttp.ClientSession, None] = None
+
+    async def fetch(self, url: str) -> Union[HttpFetchResult, None]:
+        try:
+            session = self._get_session()
+            async with session.get(url, allow_redirects=True) as response:
+                if response.status != 200:
+                    logger.debug(
+                        f"HTTP fetch of '{url}' returned {response.status}.")
+                    return None
+                content_type = response.headers.get('Content-Type', '')
+                if 'html' not in content_type:
+                    logger.debug(
+                        f"HTTP fetch of '{url}' returned '{content_type}'.")
+                    return None
+
+                # `read(n)` returns only what is buffered, so read chunks
+                # until the end of the body or the size limit.
+                max_bytes = Config.browser.http_fetch_max_bytes
+                chunks = []
+                size = 0
+                async for chunk in response.content.iter_chunked(65536):
+                    chunks.append(chunk)
+                    size += len(chunk)
+                    if size >= max_bytes:
+                        logger.debug(
+                            f"HTTP fetch of '{url}' truncated to "
+                            f"{max_bytes} bytes.")
+                        break
+                body = b''.join(chunks)[:max_bytes]
+                encoding = response.charset or 'utf-8'
+                return HttpFetchResult(
+                    url=str(response.url),
+                    status=response.status,
+                    headers=dict(response.headers),
+                    html=body.decode(encoding, errors='replace'),
+                )
+        except (aiohttp.ClientError, asyncio.TimeoutError, LookupError) as e:
+            logger.debug(f"HTTP fetch of '{url}' failed: {e}")
+            return None
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(
+                    total=Config.browser.http_fetch_timeout),
+                headers={'User-Agent': Config.browser.http_fetch_user_agent},
+                connector=aiohttp.TCPConnector(
+                    limit=Config.browser.http_fetch_max_connections),
+            )
+        return self._session
+
+
+_http_fetcher: Union[HttpFetcher, None] = None
+
+
+def get_http_fetcher() -> HttpFetcher:
+    global _http_fetcher
+    if _http_fetcher is None:
+        _http_fetcher = HttpFetcher()
+    return _http_fetcher
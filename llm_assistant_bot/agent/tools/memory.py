@@ -2,10 +2,13 @@ import datetime
 import pytz
 
 from langchain.agents import Tool
-from langchain.utilities import PythonREPL
 
 from ...config import Config
-from ...db import query_memory, add_memory, delete_memory
+from ...db import (
+    query_memory, add_memory,
+    aquery_memory, aadd_memory, aquery_memory_and_docs,
+)
+from .docs import format_doc
 
 
 def get_memory_tools(tokenizer):
@@ -14,7 +17,8 @@ def get_memory_tools(tokenizer):
         return 'Memorized.'
 
     async def memorize_arun(text):
-        return memorize_run(text)
+        await aadd_memory(text)
+        return 'Memorized.'
 
     memorize_tool = Tool(
         name="memorize",
@@ -23,22 +27,28 @@ def get_memory_tools(tokenizer):
         coroutine=memorize_arun,
     )
 
-    def check_memory_run(text):
-        if not text:
-            return 'Error: You must provide a input while using this tool.'
-        if not isinstance(text, str):
-            return 'Error: The input of this tool must be a string.'
-        text = get_memories_text(text, tokenizer=tokenizer)
+    def check_memory_output(text):
         if text:
             text += '\nNote that newer memories should override older ones if they have conflicts. It is possible that the above memories does not provide sufficient information about the topic you specified, in such case, you need to change your input or use other tools to find information.'
         else:
             text = 'No related memories found.'
         return text
 
-        return text
+    def check_memory_run(text):
+        if not text:
+            return 'Error: You must provide a input while using this tool.'
+        if not isinstance(text, str):
+            return 'Error: The input of this tool must be a string.'
+        text = get_memories_text(text, tokenizer=tokenizer)
+        return check_memory_output(text)
 
     async def check_memory_arun(text):
-        return check_memory_run(text)
+        if not text:
+            return 'Error: You must provide a input while using this tool.'
+        if not isinstance(text, str):
+            return 'Error: The input of this tool must be a string.'
+        text = await aget_memories_text(text, tokenizer=tokenizer)
+        return check_memory_output(text)
 
     check_memory_tool = Tool(
         name="check_memory",
@@ -52,28 +62,65 @@ def get_memory_tools(tokenizer):
 
 def get_memories_text(query, tokenizer):
     memories = query_memory(query, n_results=Config.agent.memory_top_n)
+    return format_memories_text(memories, tokenizer=tokenizer)
+
+
+async def aget_memories_text(query, tokenizer):
+    memories = await aquery_memory(query, n_results=Config.agent.memory_top_n)
+    return format_memories_text(memories, tokenizer=tokenizer)
+
+
+def format_memories_text(memories, tokenizer):
     memories = [m for m in memories if m['distance'] <= Config.agent.memory_max_distance]
-    memories_text = []
     tz = pytz.timezone(Config.timezone)
-    for m in memories:
-        text = m['document']
-        text = text.strip()
-        text = text.replace('\n', ' ')
-        tokenized_text = tokenizer.encode(text)
-        if len(tokenized_text) > Config.agent.memory_max_token_limit:
-            text = tokenizer.decode(tokenized_text[:Config.agent.memory_max_token_limit]) + \
-                ' ... (truncated)'
-        created_at = m['metadata'].get('created_at', None)
-        if created_at:
-            dt = datetime.datetime.fromtimestamp(created_at)
-            dt = dt.astimezone(tz)
-            formatted_dt = dt.strftime('%Y-%m-%d %H:%M:%S')
-            text = f'[Memorized at {formatted_dt}]: {text}'
-        else:
-            text = f'[Memorized at unknown date]: {text}'
-
-        memories_text.append(text)
+    memories_text = [format_memory(m, tokenizer=tokenizer, tz=tz)
+                     for m in memories]
 
     memories_text = '\n'.join(memories_text)
 
     return memories_text
+
+
+def format_memory(m, tokenizer, tz):
+    text = m['document']
+    text = text.strip()
+    text = text.replace('\n', ' ')
+    tokenized_text = tokenizer.encode(text)
+    if len(tokenized_text) > Config.agent.memory_max_token_limit:
+        text = tokenizer.decode(tokenized_text[:Config.agent.memory_max_token_limit]) + \
+            ' ... (truncated)'
+    created_at = m['metadata'].get('created_at', None)
+    if created_at:
+        dt = datetime.datetime.fromtimestamp(created_at)
+        dt = dt.astimezone(tz)
+        formatted_dt = dt.strftime('%Y-%m-%d %H:%M:%S')
+        text = f'[Memorized at {formatted_dt}]: {text}'
+    else:
+        text = f'[Memorized at unknown date]: {text}'
+    return text
+
+
+async def aget_related_context_text(query, tokenizer):
+    """
+    Retrieves memories and docs related to the query in one pass (the query
+    is embedded once for both searches), and returns them as a single list
+    ranked by distance.
+    """
+    memories, docs = await aquery_memory_and_docs(
+        query,
+        memory_n_results=Config.agent.memory_top_n,
+        docs_n_results=Config.agent.docs_top_n,
+    )
+    memories = [m for m in memories if m['distance'] <= Config.agent.memory_max_distance]
+    docs = [d for d in docs if d['distance'] <= Config.agent.docs_max_distance]
+
+    tz = pytz.timezone(Config.timezone)
+    ranked = sorted(
+        [(m['distance'], format_memory(m, tokenizer=tokenizer, tz=tz))
+         for m in memories]
+        + [(d['distance'], format_doc(d, tokenizer=tokenizer, tz=tz))
+           for d in docs],
+        key=lambda item: item[0],
+    )
+
+    return '\n'.join(text for _, text in ranked)
@@ -1,17 +1,19 @@
 from langchain.agents import Tool
-from langchain.utilities import PythonREPL
+
+from ..run_context import get_run_context
 
 
 def get_python_repl_tool():
-    python_repl = PythonREPL()
+    def python_repl_run(command):
+        return get_run_context().python_repl.run(command)
 
     async def python_repl_arun(command):
-        return python_repl.run(command)
+        return python_repl_run(command)
 
     python_repl_tool = Tool(
         name="python_repl",
         description="A Python shell. Use this to execute python commands. Input should be a valid python command, and you need to import libraries before using them. You must use `print(...)` in order to see the output. Do not use this unless it's necessary.",
-        func=python_repl.run,
+        func=python_repl_run,
         coroutine=python_repl_arun,
     )
     return python_repl_tool
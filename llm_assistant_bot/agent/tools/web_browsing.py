@@ -1,16 +1,17 @@
-from typing import Type, Optional, Union, Tuple, List, Dict
+from typing import Any, Awaitable, Callable, Type, Optional, Union, Tuple, List, Dict
 
+import re
+import asyncio
 import logging
 from urllib.parse import quote
 from pydantic import BaseModel, Field
 
-from langchain.callbacks.manager import AsyncCallbackManagerForToolRun
-from langchain.tools.playwright.utils import (
-    create_async_playwright_browser,
-    aget_current_page,
-    )
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForToolRun,
+    CallbackManagerForToolRun,
+)
+from langchain.tools.base import BaseTool
 from langchain.agents.agent_toolkits.playwright.toolkit import (
-    BaseBrowserTool,
     ClickTool,
     CurrentWebPageTool as OriginalCurrentWebPageTool,
     ExtractHyperlinksTool as OriginalExtractHyperlinksTool,
@@ -20,55 +21,196 @@ from langchain.agents.agent_toolkits.playwright.toolkit import (
     NavigateBackTool as OriginalNavigateBackTool,
 )
 
-from readability import Document
-from markdownify import markdownify
-from bs4 import BeautifulSoup
-
-
 from ...config import Config
+from ...utils.html_extraction import (
+    extract_readable_content,
+    parse_google_search_results,
+)
+from ..run_context import get_run_context
+from .browser_manager import get_browser_manager
+from .extraction_pool import get_extraction_pool
+from .http_fetcher import get_http_fetcher, needs_browser
+from .web_cache import (
+    get_web_cache,
+    get_ttl_from_headers,
+    normalize_url,
+    normalize_keyword,
+)
 
 logger = logging.getLogger("web_browsing_tool")
 
 
-class NavigateTool(OriginalNavigateTool):
-    name: str = "browser_navigate"
-    description: str = "Navigate the browser to the specified URL."
+async def get_run_page():
+    """
+    Returns the browser page leased for the current agent run, leasing one
+    from the shared browser manager on first use.
+    """
+    run_context = get_run_context()
+    page = run_context.browser_page
+    if page is None or page.is_closed():
+        page = await run_context.exit_stack.enter_async_context(
+            get_browser_manager().lease_page()
+        )
+        run_context.browser_page = page
+    return page
+
+
+def get_navigation_message(url: str, status: Any, tier: str = '') -> str:
+    message = f"Navigating to {url} returned status code {status}"
+    if tier:
+        message += f" (served by {tier})"
+    return message
+
+
+async def navigate(page, url: str) -> Tuple[str, Any]:
+    """
+    Returns a message about the navigation and the response.
+    """
+    response = await get_browser_manager().goto(page, url)
+    status = response.status if response else "unknown"
+    return get_navigation_message(url, status), response
+
+
+NO_CACHE_FLAG = '--no-cache'
+
+
+def split_no_cache_flag(tool_input: str) -> Tuple[str, bool]:
+    """
+    The agent calls tools with a single string, so cached results are
+    bypassed by ending it with `--no-cache`. Returns the input without the
+    flag, and whether it was there.
+    """
+    tool_input = tool_input.strip()
+    if tool_input.endswith(NO_CACHE_FLAG):
+        return tool_input[:-len(NO_CACHE_FLAG)].strip(), True
+    return tool_input, False
+
+
+async def get_page_output(
+    url: str,
+    get_page: Callable[[], Awaitable[Any]],
+    no_cache: bool = False,
+    browser_lock: Union[asyncio.Lock, None] = None,
+) -> str:
+    """
+    Returns the content of the page at `url`, from the cache, a plain HTTP
+    request, or the browser page returned by `get_page`. If `browser_lock`
+    is given, it is held while the browser page is used.
+    """
+    cache = None if no_cache else get_web_cache()
+    cache_key = normalize_url(url)
+    if cache:
+        cached_output = cache.get('page', cache_key)
+        if cached_output is not None:
+            logger.info(f"'{url}' was served by cache.")
+            return cached_output
+
+    logger.debug(f"Navigating to '{url}' ...")
+
+    try:
+        # Try a plain HTTP request first, and only load the page in the
+        # browser if that does not give the real content.
+        http_result = None
+        if Config.browser.http_fetch_enabled:
+            http_result = await get_http_fetcher().fetch(url)
+        if http_result is not None:
+            title, content = await get_extraction_pool().run(
+                extract_readable_content, http_result.html)
+            if needs_browser(http_result.html, content):
+                logger.debug(
+                    f"Content of '{url}' over HTTP is too thin, "
+                    "loading it in the browser.")
+                http_result = None
+
+        if http_result is not None:
+            tier = 'http'
+            status = http_result.status
+            is_ok = True
+            headers = http_result.headers
+        else:
+            tier = 'browser'
+            async with browser_lock or asyncio.Lock():
+                page = await get_page()
+                response = await get_browser_manager().goto(page, url)
+                html_content = await page.content()
+            status = response.status if response else "unknown"
+            is_ok = bool(response and response.ok)
+            headers = response.headers if response else {}
+            title, content = await get_extraction_pool().run(
+                extract_readable_content, html_content)
+        logger.info(f"'{url}' was served by {tier}.")
+
+        page_output = f'\n----\nContent:\n{title}\n{content}'
+
+        # output = output[:1024]
+
+        output_for_logging = page_output.replace('\n', '\\n')[:200]
+        logger.debug(f"Results of '{url}': {output_for_logging}")
+
+        page_output += '\n----\n'
+        # output += "Hint: you can use the browser_extract_current_page_text tool to get the full content of this page"
+
+        output = get_navigation_message(url, status, tier=tier) + page_output
+
+        if cache and is_ok:
+            # Later hits report that they were served by the cache.
+            cache.set(
+                'page', cache_key,
+                get_navigation_message(url, status, tier='cache')
+                + page_output,
+                ttl=get_ttl_from_headers(
+                    headers,
+                    default_ttl=Config.browser.web_cache_ttl,
+                    max_ttl=Config.browser.web_cache_max_ttl,
+                ),
+            )
 
-    async def _arun(
+        return output
+    except Exception as e:
+        return str(e)
+
+
+class BaseAsyncBrowserTool(BaseTool):
+    """
+    Base of the browser tools, which are async only: they use pages of the
+    shared browser, which belong to the event loop of the bot and can not
+    be driven from a sync caller.
+    """
+
+    def _run(
         self,
-        url: str,
-        run_manager: Optional[AsyncCallbackManagerForToolRun] = None
+        *args,
+        run_manager: Optional[CallbackManagerForToolRun] = None,
+        **kwargs,
     ) -> str:
-        logger.debug(f"Navigating to '{url}' ...")
+        raise NotImplementedError(f"{self.name} does not support sync")
 
-        try:
-            output = await super()._arun(url=url, run_manager=run_manager)
-            page = await aget_current_page(self.async_browser)  # type: ignore
-            html_content = await page.content()
 
-            doc = Document(html_content)
-            output += f'\n----\nContent:\n{doc.title()}\n{markdownify(doc.summary())}'
+class NavigateToolInput(BaseModel):
+    url: str = Field(..., description="url to navigate to")
 
-            # output = output[:1024]
 
-            output_for_logging = output.replace('\n', '\\n')[:200]
-            logger.debug(f"Results of '{url}': {output_for_logging}")
-
-            output += '\n----\n'
-            # output += "Hint: you can use the browser_extract_current_page_text tool to get the full content of this page"
+class NavigateTool(BaseAsyncBrowserTool):
+    name: str = "browser_navigate"
+    description: str = f"Navigate the browser to the specified URL. Recently visited pages may be served from a cache, add {NO_CACHE_FLAG} after the URL if you need the page as it is now."
+    args_schema: Type[BaseModel] = NavigateToolInput
 
-            return output
-        except Exception as e:
-            return str(e)
+    async def _arun(
+        self,
+        url: str,
+        run_manager: Optional[AsyncCallbackManagerForToolRun] = None
+    ) -> str:
+        url, no_cache = split_no_cache_flag(url)
+        return await get_page_output(url, get_run_page, no_cache=no_cache)
 
 
 class GoogleSearchToolInput(BaseModel):
     keyword: str = Field(..., description="keyword(s) for searching")
 
 
-class GoogleSearchTool(OriginalNavigateTool):
+class GoogleSearchTool(BaseAsyncBrowserTool):
     name: str = "browser_google_search"
-    description: str = "Search the specified keywords on Google. Do not use this if unnecessary, prefer other tools first and think if you can do it without Google. Also, do not use this tool to do translations. This tool should only be used as a last resort if you can't find any available data from your memory or other tools."
+    description: str = f"Search the specified keywords on Google. Do not use this if unnecessary, prefer other tools first and think if you can do it without Google. Also, do not use this tool to do translations. This tool should only be used as a last resort if you can't find any available data from your memory or other tools. Recent results may be served from a cache, add {NO_CACHE_FLAG} after the keywords if you need the latest ones."
     args_schema: Type[BaseModel] = GoogleSearchToolInput
 
     async def _arun(
@@ -76,72 +218,37 @@ class GoogleSearchTool(OriginalNavigateTool):
         keyword: str,
         run_manager: Optional[AsyncCallbackManagerForToolRun] = None,
     ) -> str:
+        keyword, no_cache = split_no_cache_flag(keyword)
+        cache = None if no_cache else get_web_cache()
+        cache_key = normalize_keyword(keyword)
+        if cache:
+            cached_output = cache.get('google_search', cache_key)
+            if cached_output is not None:
+                logger.debug(f"Using cached Google results of '{keyword}'.")
+                return cached_output
+
         logger.debug(f"Searching Google for '{keyword}' ...")
 
         url = f"https://www.google.com/search?q={quote(keyword)}"
-        output = await super()._arun(url=url, run_manager=run_manager)
-
-        page = await aget_current_page(self.async_browser)  # type: ignore
-        html_content = await page.content()
+        try:
+            page = await get_run_page()
+            output, _ = await navigate(page, url)
 
-        # doc = Document(html_content)
-        soup = BeautifulSoup(html_content, 'html.parser')
-        search_results_element = soup.find(id='search')
+            html_content = await page.content()
 
-        # import pdb
-        # pdb.set_trace()
+            results = await get_extraction_pool().run(
+                parse_google_search_results, html_content)
+        except Exception as e:
+            # Report it to the agent like `get_page_output` does, instead of
+            # ending the run.
+            logger.warning(f"Searching Google for '{keyword}' failed: {e}")
+            return f"Failed to search Google for '{keyword}': {e}"
 
-        if not search_results_element:
+        if results is None:
             output += '\n'
             output += 'Cannot parse search result'
             return output
 
-        link_elements = search_results_element.find_all(
-            lambda tag: (
-                tag.has_attr('href')
-                and tag['href'].startswith('http')
-                and not tag['href'].startswith(
-                    'https://www.google.com/search'
-                )
-                and not tag['href'].startswith(
-                    'https://translate.google.com'
-                )
-            )
-        )
-
-        def find_description(elem, max_depth=4):
-            current_depth = 0
-            parent_elem = elem
-
-            while current_depth <= max_depth:
-                parent_elem = parent_elem.parent
-                if not parent_elem:
-                    break
-                if parent_elem.has_attr('lang'):
-                    break
-
-            if not parent_elem:
-                return None
-
-            container_elem = parent_elem.find(
-                lambda tag: (
-                    tag.has_attr('data-sncf')
-                    and tag['data-sncf'].strip().startswith('1')
-                    )
-                )
-            if not container_elem:
-                return None
-
-            return container_elem.text.strip()
-
-        results = [
-            (elem.text, elem['href'], find_description(elem))
-            for elem in link_elements
-        ]
-
-        # import pdb
-        # pdb.set_trace()
-
         logger.debug(f"Google search results of '{keyword}': {results}.")
 
         search_results = []
@@ -163,6 +270,14 @@ class GoogleSearchTool(OriginalNavigateTool):
         output += '\n----\n'
         output += "Hint: you can use the browser_navigate tool to navigate to the URLs."
 
+        # Google marks its result pages as not cacheable, so its headers are
+        # not respected here.
+        if cache:
+            cache.set(
+                'google_search', cache_key, output,
+                ttl=Config.browser.web_cache_search_ttl,
+            )
+
         return output
 
 
@@ -199,7 +314,7 @@ class GoogleSearchTool(OriginalNavigateTool):
 #         return output[:2048]
 
 
-class GetPageContentTool(OriginalExtractTextTool):
+class GetPageContentTool(BaseAsyncBrowserTool):
     name: str = "browser_extract_current_page_text"
     description: str = "Extract the full text content on the current webpage, before using this tool, you should use browser_navigate to navigate to the desired page."
     # To avoid StopIteration error raised at
@@ -217,16 +332,110 @@ class GetPageContentTool(OriginalExtractTextTool):
     async def _arun(
         self, run_manager: Optional[AsyncCallbackManagerForToolRun] = None
     ) -> str:
-        page = await aget_current_page(self.async_browser)  # type: ignore
+        page = await get_run_page()
         html_content = await page.content()
 
-        doc = Document(html_content)
+        title, content = await get_extraction_pool().run(
+            extract_readable_content, html_content)
 
-        output = f'Title: "{doc.title()}", Content:\n{markdownify(doc.summary())}'
+        output = f'Title: "{title}", Content:\n{content}'
 
         return output[:4096]
 
 
+def allocate_token_budget(lengths: List[int], budget: int) -> List[int]:
+    """
+    Splits `budget` between texts of the given token lengths, evenly but
+    giving what short texts do not use to the longer ones.
+    """
+    limits = [0] * len(lengths)
+    remaining = budget
+    pending = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    while pending:
+        share = remaining // len(pending)
+        i = pending.pop(0)
+        limits[i] = min(lengths[i], share)
+        remaining -= limits[i]
+    return limits
+
+
+def split_urls(text: str) -> List[str]:
+    """
+    Splits a list of URLs on whitespace, and on commas that are followed by
+    whitespace or another URL, so that URLs containing commas (e.g. in
+    query strings) stay whole.
+    """
+    return [u for u in re.split(r'\s+|,(?=\s|https?://)', text) if u]
+
+
+class FetchPagesToolInput(BaseModel):
+    urls: str = Field(..., description="urls separated by spaces")
+
+
+class FetchPagesTool(BaseAsyncBrowserTool):
+    name: str = "browser_fetch_pages"
+    description: str = "Fetch several web pages at once and get a digest of their content. Input should be URLs separated by spaces, such as the top results of a Google search. Commas inside URLs are kept as part of them. Prefer this over browser_navigate when you need to read more than one page."
+    args_schema: Type[BaseModel] = FetchPagesToolInput
+
+    tokenizer: Any
+
+    async def _arun(
+        self,
+        urls: str,
+        run_manager: Optional[AsyncCallbackManagerForToolRun] = None,
+    ) -> str:
+        url_list = list(dict.fromkeys(
+            u for u in (
+                u.strip('"\'<>,') for u in split_urls(urls)
+            )
+            if u.startswith('http')
+        ))
+        if not url_list:
+            return 'Error: You must provide at least one URL.'
+        max_urls = Config.browser.fetch_pages_max_urls
+        skipped_urls = url_list[max_urls:]
+        url_list = url_list[:max_urls]
+
+        logger.debug(f"Fetching {len(url_list)} pages: {url_list} ...")
+
+        semaphore = asyncio.Semaphore(Config.browser.fetch_pages_max_concurrency)
+        # Pages are fetched over HTTP at the same time, but the ones that
+        # need the browser take turns on the page of the run, so that this
+        # tool never takes pages from the pool that other runs need.
+        browser_lock = asyncio.Lock()
+
+        async def fetch(url: str) -> str:
+            async with semaphore:
+                try:
+                    return await get_page_output(
+                        url, get_run_page, browser_lock=browser_lock)
+                except Exception as e:
+                    return f"Failed to fetch {url}: {e}"
+
+        outputs = await asyncio.gather(*(fetch(url) for url in url_list))
+
+        tokenized_outputs = [
+            self.tokenizer.encode(output.strip()) for output in outputs]
+        limits = allocate_token_budget(
+            [len(t) for t in tokenized_outputs],
+            Config.browser.fetch_pages_max_token_limit,
+        )
+        digest = []
+        for i, (tokens, limit) in enumerate(
+            zip(tokenized_outputs, limits), start=1
+        ):
+            text = self.tokenizer.decode(tokens[:limit])
+            if limit < len(tokens):
+                text += ' ... (truncated)'
+            digest.append(f"[{i}] {text}")
+
+        output = '\n----\n'.join(digest)
+        output += '\n----\n'
+        if skipped_urls:
+            output += f"Skipped (only {max_urls} pages at once): {' '.join(skipped_urls)}\n"
+        return output
+
+
 # class NavigateBackTool(OriginalNavigateBackTool):
 #     # To avoid StopIteration error raised at
 #     # https://github.com/hwchase17/langchain/blob/cf5803e/langchain/tools/base.py#L185
@@ -240,10 +449,11 @@ class GetPageContentTool(OriginalExtractTextTool):
 #         return (), {}
 
 
-browser_tools_classes: List[Type[BaseBrowserTool]] = [
+browser_tools_classes: List[Type[BaseTool]] = [
     # ClickTool,
     GoogleSearchTool,
     NavigateTool,
+    FetchPagesTool,
     # NavigateBackTool,
     # GetPageContentTool,
     # ExtractHyperlinksTool,
@@ -252,19 +462,12 @@ browser_tools_classes: List[Type[BaseBrowserTool]] = [
 ]
 
 
-def get_async_browser():
-    async_browser = create_async_playwright_browser()
-    return async_browser
-
-
-def get_browser_tools(async_browser=None):
-    if not async_browser:
-        async_browser = get_async_browser()
-
+def get_browser_tools(tokenizer):
+    # The tools do not hold a browser themselves, pages are leased from the
+    # shared browser manager per agent run.
     browser_tools = [
-        tool_cls.from_browser(
-            sync_browser=None, async_browser=async_browser,
-        )
+        tool_cls(tokenizer=tokenizer)  # type: ignore
+        if tool_cls is FetchPagesTool else tool_cls()
         for tool_cls in browser_tools_classes
     ]
 
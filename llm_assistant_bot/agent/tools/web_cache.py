@@ -0,0 +1,224 @@
+from typing import Mapping, Tuple, Union
+
+import os
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+from ...config import Config
+
+CacheKey = Tuple[str, str]
+
+
+def normalize_url(url: str) -> str:
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    if (
+        (scheme == 'http' and netloc.endswith(':80'))
+        or (scheme == 'https' and netloc.endswith(':443'))
+    ):
+        netloc = netloc.rsplit(':', 1)[0]
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, netloc, parts.path or '/', query, ''))
+
+
+def normalize_keyword(keyword: str) -> str:
+    return ' '.join(keyword.lower().split())
+
+
+def get_ttl_from_headers(
+    headers: Mapping[str, str], default_ttl: int, max_ttl: int
+) -> int:
+    """
+    Returns how long a response may be cached according to its
+    `Cache-Control` header, or `default_ttl` if the header says nothing
+    about it. 0 means it should not be cached.
+
+    The cache is shared by all conversations, so `private` responses are
+    not cached either.
+    """
+    cache_control = ''
+    for name, value in headers.items():
+        if name.lower() == 'cache-control':
+            cache_control = value.lower()
+            break
+    if not cache_control:
+        return default_ttl
+
+    directives = {}
+    for directive in cache_control.split(','):
+        name, _, value = directive.partition('=')
+        directives[name.strip()] = value.strip().strip('"')
+
+    if any(d in directives for d in ('no-store', 'no-cache', 'private')):
+        return 0
+    for name in ('s-maxage', 'max-age'):
+        if directives.get(name, '').isdigit():
+            return min(int(directives[name]), max_ttl)
+    return default_ttl
+
+
+class WebCache():
+    """
+    Caches the output of web browsing tools, keyed by `(kind, key)` such as
+    a normalized URL or search keyword. Entries live in an in-memory LRU
+    that holds up to `memory_max_size` characters. Entries evicted from it
+    spill to SQLite, which holds up to `disk_max_entries` entries.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        memory_max_size: int,
+        disk_max_entries: int,
+    ):
+        self.path = path
+        self.memory_max_size = memory_max_size
+        self.disk_max_entries = disk_max_entries
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        # Key -> (expires_at, value)
+        self._memory: 'OrderedDict[CacheKey, Tuple[float, str]]' = \
+            OrderedDict()
+        self._memory_size = 0
+
+        dir_path = os.path.dirname(path)
+        if dir_path:
+            os.makedirs(dir_path, exist_ok=True)
+        self._conn = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS web_cache (
+                kind TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                last_used_at REAL NOT NULL,
+                PRIMARY KEY (kind, key)
+            )
+        ''')
+
+    def get(self, kind: str, key: str) -> Union[str, None]:
+        cache_key = (kind, key)
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(cache_key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._memory.move_to_end(cache_key)
+                    self.hits += 1
+                    return entry[1]
+                self._forget(cache_key)
+
+            row = self._conn.execute(
+                'SELECT value, expires_at FROM web_cache '
+                'WHERE kind = ? AND key = ?',
+                cache_key,
+            ).fetchone()
+            if row is None or row[1] <= now:
+                self.misses += 1
+                return None
+
+            self._remember(cache_key, row[1], row[0])
+            self.hits += 1
+            return row[0]
+
+    def set(self, kind: str, key: str, value: str, ttl: int):
+        if ttl <= 0 or len(value) > self.memory_max_size:
+            return
+        cache_key = (kind, key)
+        with self._lock:
+            self._conn.execute(
+                'DELETE FROM web_cache WHERE kind = ? AND key = ?', cache_key)
+            self._remember(cache_key, time.time() + ttl, value)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'memory_entries': len(self._memory),
+                'memory_size': self._memory_size,
+                'disk_entries': self._conn.execute(
+                    'SELECT COUNT(*) FROM web_cache').fetchone()[0],
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_size = 0
+            self._conn.execute('DELETE FROM web_cache')
+
+    def _remember(self, cache_key: CacheKey, expires_at: float, value: str):
+        self._forget(cache_key)
+        self._memory[cache_key] = (expires_at, value)
+        self._memory_size += len(value)
+
+        spilled = []
+        now = time.time()
+        while self._memory_size > self.memory_max_size:
+            evicted_key, (evicted_expires_at, evicted_value) = \
+                self._memory.popitem(last=False)
+            self._memory_size -= len(evicted_value)
+            if evicted_expires_at > now:
+                spilled.append((
+                    *evicted_key, evicted_value, evicted_expires_at, now,
+                ))
+        if spilled:
+            self._spill(spilled)
+
+    def _forget(self, cache_key: CacheKey):
+        entry = self._memory.pop(cache_key, None)
+        if entry is not None:
+            self._memory_size -= len(entry[1])
+
+    def _spill(self, rows):
+        now = time.time()
+        self._conn.execute('BEGIN')
+        try:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO web_cache '
+                '(kind, key, value, expires_at, last_used_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                rows,
+            )
+            self._conn.execute(
+                'DELETE FROM web_cache WHERE expires_at <= ?', (now,))
+            self._conn.execute(
+                'DELETE FROM web_cache WHERE rowid IN ('
+                'SELECT rowid FROM web_cache ORDER BY last_used_at DESC '
+                'LIMIT -1 OFFSET ?)',
+                (self.disk_max_entries,),
+            )
+        except Exception:
+            self._conn.execute('ROLLBACK')
+            raise
+        self._conn.execute('COMMIT')
+
+
+_web_cache: Union[WebCache, None] = None
+_web_cache_lock = threading.Lock()
+
+
+def get_web_cache() -> Union[WebCache, None]:
+    global _web_cache
+    if not Config.browser.web_cache_enabled:
+        return None
+    if _web_cache is None:
+        with _web_cache_lock:
+            if _web_cache is None:
+                _web_cache = WebCache(
+                    path=Config.browser.web_cache_path,
+                    memory_max_size=Config.browser.web_cache_memory_max_size,
+                    disk_max_entries=Config.browser.web_cache_disk_max_entries,
+                )
+    return _web_cache
@@ -1,7 +1,17 @@
+import os
+
+from ..paths import app_dir
+
+
 class AgentConfig:
     max_generate_tokens: int = 512
     max_execution_time: int = 180
     conversation_memory_max_token_limit: int = 200
+    # Keep the summary of older messages of each conversation, so that only
+    # newly overflowed messages need to be summarized on the next reply.
+    conversation_summary_cache_enabled: bool = True
+    conversation_summary_cache_path: str = \
+        os.path.join(app_dir, '.cache', 'conversation_summaries.sqlite3')
     old_observation_max_token_limit: int = 100
 
     memory_top_n: int = 8
@@ -10,6 +20,12 @@ class AgentConfig:
     docs_top_n: int = 8
     docs_max_distance: float = 0.5
     docs_max_token_limit: int = 100
+    # Also put docs related to the user's message into the prompt, ranked
+    # together with the memories.
+    auto_retrieve_docs: bool = False
+
+    # Stream the final reply to the user while it is being generated.
+    stream_final_reply: bool = False
 
     llm_type: str = 'openai'
     llm_model_name: str = 'text-davinci-003'
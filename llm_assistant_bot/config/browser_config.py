@@ -0,0 +1,78 @@
+import os
+
+from ..paths import app_dir
+
+
+class BrowserConfig:
+    headless: bool = True
+
+    # Maximum number of pages that can be leased at the same time. Agent runs
+    # that need a page while all of them are in use will wait in a queue.
+    max_pages: int = 4
+    # Number of pages to open when the bot starts.
+    warm_up_pages: int = 1
+    # Seconds to wait for a free page before giving up.
+    page_lease_timeout: int = 60
+    # Seconds between checks of whether the browser is still alive.
+    health_check_interval: int = 30
+
+    # Requests of these resource types (as in Playwright's
+    # `request.resource_type`) and to these domains (and their subdomains)
+    # are blocked, since they do not change the content of the page.
+    blocked_resource_types: list = ['image', 'media', 'font']
+    blocked_domains: list = [
+        'doubleclick.net',
+        'googlesyndication.com',
+        'googletagmanager.com',
+        'google-analytics.com',
+        'facebook.net',
+        'hotjar.com',
+        'scorecardresearch.com',
+    ]
+    # Navigations wait for this load state ('domcontentloaded', 'load' or
+    # 'networkidle'), but at most `navigation_timeout` seconds, after which
+    # whatever has been loaded is used. Once `navigation_max_bytes` bytes
+    # have been loaded, further subresource requests are blocked. Pages only
+    # reach the browser when they need JavaScript to render, which has
+    # usually not run yet at 'domcontentloaded'.
+    navigation_wait_until: str = 'load'
+    navigation_timeout: int = 15
+    navigation_max_bytes: int = 10000000
+
+    # Number of processes extracting the content of pages, so that it does
+    # not block the bot.
+    extraction_workers: int = 2
+    # Seconds an extraction may take before it is given up.
+    extraction_timeout: int = 10
+    # Longer HTML is truncated before extraction.
+    extraction_max_html_length: int = 2000000
+
+    # Fetch pages with a plain HTTP request first, and only load them in the
+    # browser if the content is thinner than `http_fetch_min_content_length`
+    # characters or the page asks for JavaScript.
+    http_fetch_enabled: bool = True
+    http_fetch_timeout: int = 10
+    http_fetch_max_bytes: int = 5000000
+    http_fetch_max_connections: int = 20
+    http_fetch_min_content_length: int = 500
+    http_fetch_user_agent: str = \
+        'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 ' \
+        '(KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36'
+
+    # Used by the browser_fetch_pages tool, which fetches several pages at
+    # once and fits their content into `fetch_pages_max_token_limit` tokens.
+    fetch_pages_max_urls: int = 5
+    fetch_pages_max_concurrency: int = 3
+    fetch_pages_max_token_limit: int = 1500
+
+    # Cache the content of pages and Google search results. Pages are kept
+    # for as long as their `Cache-Control` header allows, or `web_cache_ttl`
+    # seconds if it does not say, but never more than `web_cache_max_ttl`.
+    web_cache_enabled: bool = True
+    web_cache_ttl: int = 600
+    web_cache_max_ttl: int = 86400
+    web_cache_search_ttl: int = 600
+    # Characters of content kept in memory, the rest spills to disk.
+    web_cache_memory_max_size: int = 10000000
+    web_cache_disk_max_entries: int = 5000
+    web_cache_path: str = os.path.join(app_dir, '.cache', 'web.sqlite3')
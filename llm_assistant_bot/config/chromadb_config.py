@@ -8,3 +8,35 @@ class ChromaDBConfig:
 
     embedding_function_type: str = 'openai'
     embedding_function_model_name: str = 'text-embedding-ada-002'
+
+    # Maximum number of embedding requests sent at the same time by the async
+    # data access functions.
+    max_concurrent_embedding_requests: int = 4
+    # Number of threads running the blocking vector store operations. The
+    # duckdb+parquet backend is not safe for concurrent use, so the calls to
+    # the store are serialized whatever this is. More threads only let work
+    # around them, such as computing the embeddings of queries that come
+    # without them, overlap.
+    db_executor_max_workers: int = 1
+
+    # Embeddings are cached on disk by model name and text hash, so identical
+    # texts are only embedded once.
+    embedding_cache_enabled: bool = True
+    embedding_cache_path: str = \
+        os.path.join(app_dir, '.cache', 'embeddings.sqlite3')
+    embedding_cache_max_entries: int = 100000
+    # Number of embeddings also kept in memory.
+    embedding_cache_memory_max_entries: int = 2000
+
+    # 'batched': coalesce mutations and persist them after
+    # `persist_max_delay` seconds or once `persist_max_pending_mutations`
+    # documents have been added or deleted, and at shutdown. 'immediate':
+    # persist after every mutation.
+    persist_mode: str = 'batched'
+    persist_max_delay: int = 5
+    persist_max_pending_mutations: int = 50
+
+    # Used by `ingest_docs`.
+    ingestion_batch_size: int = 100
+    ingestion_max_concurrency: int = 4
+    ingestion_max_retries: int = 3
@@ -2,6 +2,7 @@ import typing
 from typing import Type, Any, Dict
 
 from .agent_config import AgentConfig
+from .browser_config import BrowserConfig
 from .chromadb_config import ChromaDBConfig
 from .slack_config import SlackConfig
 
@@ -18,6 +19,7 @@ class Config:
     log_level: str = 'info'
 
     agent: Type[AgentConfig] = AgentConfig
+    browser: Type[BrowserConfig] = BrowserConfig
     chromadb: Type[ChromaDBConfig] = ChromaDBConfig
     slack: Type[SlackConfig] = SlackConfig
 
@@ -44,6 +46,13 @@ def set_config(config_dict: Dict[str, Any], target=Config, key_prefix=''):
             set_config(value, getattr(target, key), f'{key_prefix}{key}.')
             continue
 
+        elif (
+            type_hint is float
+            and isinstance(value, int) and not isinstance(value, bool)
+        ):
+            # Allow whole numbers such as `1` for float options.
+            value = float(value)
+
         elif not isinstance(value, type_hints[key]):
             raise TypeError(
                 f"Invalid type for config '{key_prefix}{key}': Expected '{type_hints[key]}', got '{type(value)}'.")
@@ -1,6 +1,49 @@
+import os
+
+from ..paths import app_dir
+
+
 class SlackConfig:
     bot_host: str = '0.0.0.0'
     bot_port: int = 3000
+    # Number of processes serving the bot. With more than one, the vector
+    # store is owned by a separate process, and the caches are shared through
+    # SQLite. Concurrency limits apply to each process.
+    workers: int = 1
 
     bot_user_oauth_token: str = ''
     signing_secret: str = ''
+
+    # Number of worker tasks handling messages, and how many messages may
+    # wait for a worker before new ones are rejected. 0 means enough workers
+    # for `max_concurrent_runs` runs plus `max_queued_runs` waiting ones, so
+    # that waiting messages get a queue position and the run queue limit
+    # applies.
+    job_workers: int = 0
+    job_queue_max_size: int = 100
+    # Seconds an event ID is remembered to ignore retried deliveries.
+    event_dedupe_ttl: int = 600
+    # Used to share seen event IDs when there are several workers.
+    event_dedupe_path: str = \
+        os.path.join(app_dir, '.cache', 'slack_events.sqlite3')
+
+    # Limits of agent runs happening at once. Messages beyond these wait in
+    # a queue, and are rejected once more than `max_queued_runs` are waiting.
+    max_concurrent_runs: int = 4
+    max_concurrent_runs_per_channel: int = 2
+    max_queued_runs: int = 20
+
+    # Minimum seconds between two status updates of the same message.
+    status_update_interval: float = 1.0
+
+    # Number of threads whose messages are kept in memory.
+    thread_cache_max_threads: int = 1000
+    # Also keep cached threads in SQLite, so they survive restarts.
+    thread_cache_persist: bool = False
+    thread_cache_path: str = \
+        os.path.join(app_dir, '.cache', 'slack_threads.sqlite3')
+
+    # Seconds a cached user profile stays valid.
+    user_cache_ttl: int = 3600
+    # Load all users of the workspace with `users.list` at startup.
+    user_cache_warm_up: bool = True
@@ -1,9 +1,28 @@
 from .chromadb import (
-    chromadb_client as chromadb_client,
+    get_chromadb_client as get_chromadb_client,
     add_memory as add_memory,
     query_memory as query_memory,
     delete_memory as delete_memory,
     add_docs as add_docs,
     query_docs as query_docs,
     delete_docs_by_type as delete_docs_by_type,
+    delete_collection as delete_collection,
+    flush as flush,
+    aadd_memory as aadd_memory,
+    aquery_memory as aquery_memory,
+    adelete_memory as adelete_memory,
+    aadd_docs as aadd_docs,
+    aquery_docs as aquery_docs,
+    adelete_docs_by_type as adelete_docs_by_type,
+    aquery_memory_and_docs as aquery_memory_and_docs,
+)
+from .embedding_cache import (
+    embedding_cache_stats as embedding_cache_stats,
+    clear_embedding_cache as clear_embedding_cache,
+)
+from .ingestion import (
+    ingest_docs as ingest_docs,
+    aingest_docs as aingest_docs,
+    resync_docs as resync_docs,
+    aresync_docs as aresync_docs,
 )
@@ -0,0 +1,76 @@
+from typing import Any, Dict, Tuple
+
+import signal
+import logging
+import multiprocessing
+from multiprocessing.managers import BaseManager
+
+from .chromadb import db_operations, set_remote_db
+
+logger = logging.getLogger("chroma_server")
+
+
+class ChromaService():
+    """
+    Runs the db operations in the process that owns the store, on behalf of
+    worker processes.
+    """
+
+    def call(self, name: str, args: Tuple[Any, ...], kwargs: Dict[str, Any]):
+        operation = db_operations.get(name)
+        if operation is None:
+            raise ValueError(f'Unknown db operation: {name}')
+        return operation(*args, **kwargs)
+
+
+_chroma_service = ChromaService()
+
+
+class ChromaManager(BaseManager):
+    pass
+
+
+ChromaManager.register(
+    'chroma', callable=lambda: _chroma_service, exposed=['call'])
+
+
+def _ignore_sigint():
+    # The server is stopped by the parent after the workers have exited, so
+    # Ctrl-C must not kill it before the store is persisted.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def start_chroma_server() -> ChromaManager:
+    """
+    Starts a process that owns the vector store. Worker processes forked
+    from this process access it through
+    `connect_chroma_server(manager.address)`.
+    """
+    # Forked, so that the server shares the loaded config. The authkey
+    # defaults to the one of the current process, which forked workers
+    # inherit.
+    manager = ChromaManager(
+        address=('127.0.0.1', 0),
+        ctx=multiprocessing.get_context('fork'),
+    )
+    manager.start(initializer=_ignore_sigint)
+    logger.info(f"Chroma server started at {manager.address}.")
+    return manager
+
+
+def stop_chroma_server(manager: ChromaManager):
+    try:
+        manager.chroma().call('flush', (), {})  # type: ignore
+    except Exception as e:
+        logger.error(f"Failed to persist the vector store: {e}")
+    manager.shutdown()
+
+
+def connect_chroma_server(address: Any):
+    """
+    Makes the db operations of this process run in the process that owns the
+    store.
+    """
+    manager = ChromaManager(address=address)
+    manager.connect()
+    set_remote_db(manager.chroma())  # type: ignore
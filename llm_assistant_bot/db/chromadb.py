@@ -1,117 +1,357 @@
+from typing import Any, Callable, Dict, List, Union
+
 import time
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+import openai
 import chromadb
 from chromadb.utils import embedding_functions
 
 
 from ..config import Config
-from ..utils.get_random_hex import get_random_hex
+from ..utils.get_content_hash import get_content_hash
+from .embedding_cache import CachedEmbeddingFunction, get_embedding_cache
+from .persist_scheduler import PersistScheduler
 
 from chromadb.config import Settings
-client = chromadb.Client(Settings(
-    chroma_db_impl="duckdb+parquet",
-    persist_directory=Config.chromadb.persist_directory,
-))
-chromadb_client = client
+
+# Serializes the calls to the client, which is not safe to use from several
+# threads at once (e.g. the db executor and the persist timer). Embeddings
+# are computed before taking it, see `_embed`.
+_db_lock = threading.RLock()
+
+_client: Any = None
+
+
+def get_chromadb_client():
+    """
+    Returns the Chroma client, creating it on first use. Importing this
+    module does not load the store, which keeps processes that only import
+    the bot (such as the extraction workers) light.
+    """
+    global _client
+    if _client is None:
+        with _db_lock:
+            if _client is None:
+                _client = chromadb.Client(Settings(
+                    chroma_db_impl="duckdb+parquet",
+                    persist_directory=Config.chromadb.persist_directory,
+                ))
+    return _client
+
+# Set in worker processes of the multi-process mode, where the store is
+# owned by another process (see `chroma_server.py`).
+_remote_db: Any = None
+db_operations: Dict[str, Callable[..., Any]] = {}
+
+
+def set_remote_db(remote_db: Any):
+    global _remote_db
+    _remote_db = remote_db
+
+
+def db_operation(func):
+    """
+    Runs the function under the db lock, or forwards the call to the process
+    that owns the store if there is one.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _remote_db is not None:
+            return _remote_db.call(func.__name__, args, kwargs)
+        with _db_lock:
+            return func(*args, **kwargs)
+    db_operations[func.__name__] = wrapper
+    return wrapper
+
+
+def _persist():
+    get_chromadb_client().persist()
+
+
+persist_scheduler = PersistScheduler(
+    persist=_persist,
+    get_mode=lambda: Config.chromadb.persist_mode,
+    get_max_delay=lambda: Config.chromadb.persist_max_delay,
+    get_max_pending=lambda: Config.chromadb.persist_max_pending_mutations,
+    lock=_db_lock,
+)
+
+
+@db_operation
+def flush():
+    """
+    Persists pending mutations of the vector store to disk now.
+    """
+    persist_scheduler.flush()
 
 
 def get_embedding_function():
     function_type = Config.chromadb.embedding_function_type
     model_name = Config.chromadb.embedding_function_model_name
     if function_type == 'openai':
-        return embedding_functions.OpenAIEmbeddingFunction(
-            api_key=Config.openai_api_key,
+        return CachedEmbeddingFunction(
+            embedding_functions.OpenAIEmbeddingFunction(
+                api_key=Config.openai_api_key,
+                model_name=model_name,
+            ),
             model_name=model_name,
         )
     else:
         raise NotImplementedError(f'embedding_function_type: {function_type}')
 
 
+def _embed(texts):
+    # Runs outside of the db lock, so that an embedding request does not
+    # hold up every other access to the store.
+    return get_embedding_function()(texts)
+
+
+class _CollectionEntry():
+    def __init__(self, key, collection):
+        self.key = key
+        self.collection = collection
+        # None means unknown, and will be checked with `count()` once.
+        self.is_empty: Union[bool, None] = None
+
+
+class CollectionRegistry():
+    """
+    Resolves each collection and its embedding function once, instead of on
+    every query or insert. Entries are re-resolved when the embedding config
+    changes, and can be invalidated explicitly.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _get_entry(self, name) -> _CollectionEntry:
+        key = (
+            Config.chromadb.embedding_function_type,
+            Config.chromadb.embedding_function_model_name,
+            Config.openai_api_key,
+        )
+        entry = self._entries.get(name)
+        if entry is not None and entry.key == key:
+            return entry
+
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None or entry.key != key:
+                entry = _CollectionEntry(
+                    key,
+                    get_chromadb_client().get_or_create_collection(
+                        name=name,
+                        embedding_function=get_embedding_function()
+                    ),
+                )
+                self._entries[name] = entry
+            return entry
+
+    def get(self, name):
+        return self._get_entry(name).collection
+
+    def is_empty(self, name) -> bool:
+        entry = self._get_entry(name)
+        if entry.is_empty is None:
+            entry.is_empty = entry.collection.count() <= 0
+        return entry.is_empty
+
+    def mark_added(self, name):
+        self._get_entry(name).is_empty = False
+
+    def mark_deleted(self, name):
+        # The collection may or may not be empty now.
+        self._get_entry(name).is_empty = None
+
+    def invalidate(self, name=None):
+        with self._lock:
+            if name is None:
+                self._entries = {}
+            else:
+                self._entries.pop(name, None)
+
+
+collection_registry = CollectionRegistry()
+
+
+@db_operation
+def delete_collection(name):
+    get_chromadb_client().delete_collection(name=name)
+    collection_registry.invalidate(name)
+    persist_scheduler.mark_dirty()
+
+
+@db_operation
+def is_collection_empty(name):
+    return collection_registry.is_empty(name)
+
+
 def get_memory_collection():
-    return client.get_or_create_collection(
-        name="memory",
-        embedding_function=get_embedding_function()
+    return collection_registry.get("memory")
+
+
+def get_memory_id(text):
+    return get_content_hash('memory', text)
+
+
+def get_doc_id(type_, doc):
+    return get_content_hash('docs', type_, doc.page_content, doc.metadata)
+
+
+def dedupe_by_id(ids, *lists):
+    """
+    Keeps the last item of each id, since a batch with repeated ids can not
+    be written to the store.
+    """
+    index_by_id = {doc_id: i for i, doc_id in enumerate(ids)}
+    if len(index_by_id) == len(ids):
+        return (ids, *lists)
+    indexes = sorted(index_by_id.values())
+    return (
+        [ids[i] for i in indexes],
+        *(
+            [l[i] for i in indexes] if l is not None else None
+            for l in lists
+        ),
     )
 
 
-def add_memory(text_list):
+def add_memory(text_list, embeddings=None):
     if not isinstance(text_list, list):
         text_list = [text_list]
     timestamp = get_current_timestamp()
     ids = []
     metadatas = []
 
-    for _ in text_list:
-        ids.append(get_random_hex())
+    for text in text_list:
+        # Memorizing the same text again only refreshes its timestamp.
+        ids.append(get_memory_id(text))
         metadatas.append({'created_at': timestamp})
 
-    memory_collection = get_memory_collection()
-    memory_collection.add(
-        documents=text_list,
-        ids=ids,
-        metadatas=metadatas,
+    ids, text_list, embeddings, metadatas = \
+        dedupe_by_id(ids, text_list, embeddings, metadatas)
+
+    _upsert_collection("memory", ids, text_list, embeddings, metadatas)
+
+
+def query_memory(query_list, n_results=10, query_embeddings=None):
+    """
+    Returns the results of the query, or a list of results for each query if
+    `query_list` is a list.
+    """
+    return _query_collection(
+        "memory", query_list,
+        n_results=n_results, query_embeddings=query_embeddings,
     )
-    client.persist()
 
 
-def query_memory(query_list, n_results=10):
-    if not isinstance(query_list, list):
-        query_list = [query_list]
+@db_operation
+def delete_memory(ids):
+    if not isinstance(ids, list):
+        ids = [ids]
 
     memory_collection = get_memory_collection()
-    if memory_collection.count() <= 0:
-        return []
+    memory_collection.delete(ids=ids)
+    collection_registry.mark_deleted("memory")
+    persist_scheduler.mark_dirty(len(ids))
+
+
+def _query_collection(name, query_list, n_results, query_embeddings=None):
+    is_single_query = not isinstance(query_list, list)
+    if is_single_query:
+        query_list = [query_list]
 
-    results = memory_collection.query(
-        query_texts=query_list,
+    if not query_list or is_collection_empty(name):
+        results_list = [[] for _ in query_list]
+    else:
+        if query_embeddings is None:
+            query_embeddings = _embed(query_list)
+        results_list = _query_collection_by_embeddings(
+            name, query_embeddings, n_results)
+
+    if is_single_query:
+        return results_list[0]
+    return results_list
+
+
+@db_operation
+def _query_collection_by_embeddings(name, query_embeddings, n_results):
+    if collection_registry.is_empty(name):
+        return [[] for _ in query_embeddings]
+    # All queries are searched in one call.
+    results = collection_registry.get(name).query(
+        query_embeddings=query_embeddings,
         n_results=n_results,
     )
+    return _build_query_results(results)
+
+
+def _upsert_collection(name, ids, documents, embeddings, metadatas):
+    if embeddings is None:
+        embeddings = _embed(documents)
+    _upsert_collection_with_embeddings(
+        name, ids, documents, embeddings, metadatas)
+
+
+@db_operation
+def _upsert_collection_with_embeddings(
+    name, ids, documents, embeddings, metadatas
+):
+    collection_registry.get(name).upsert(
+        documents=documents,
+        embeddings=embeddings,
+        ids=ids,
+        metadatas=metadatas,
+    )
+    collection_registry.mark_added(name)
+    persist_scheduler.mark_dirty(len(ids))
+
 
+def _build_query_results(results):
     return [
-        {
-            'id': doc_id,
-            'document': document,
-            'metadata': metadata,
-            'distance': distance,
-        }
-        for doc_id, document, metadata, distance
+        [
+            {
+                'id': doc_id,
+                'document': document,
+                'metadata': metadata,
+                'distance': distance,
+            }
+            for doc_id, document, metadata, distance
+            in zip(ids, documents, metadatas, distances)
+        ]
+        for ids, documents, metadatas, distances
         in zip(
-            results['ids'][0],
-            (results['documents'] or [])[0],
-            (results['metadatas'] or [])[0],
-            (results['distances'] or [])[0],
+            results['ids'],
+            results['documents'] or [[] for _ in results['ids']],
+            results['metadatas'] or [[] for _ in results['ids']],
+            results['distances'] or [[] for _ in results['ids']],
         )
     ]
 
 
-def delete_memory(ids):
-    if not isinstance(ids, list):
-        ids = [ids]
-
-    memory_collection = get_memory_collection()
-    memory_collection.delete(ids=ids)
-    client.persist()
-
-
 def get_current_timestamp():
     return int(time.time())
 
 
 def get_docs_collection():
-    return client.get_or_create_collection(
-        name="docs",
-        embedding_function=get_embedding_function()
-    )
+    return collection_registry.get("docs")
 
 
-def add_docs(type_, docs):
+def add_docs(type_, docs, embeddings=None):
     timestamp = get_current_timestamp()
     text_list = []
     ids = []
     metadatas = []
 
     for d in docs:
-        ids.append(get_random_hex())
+        # Importing the same chunk again overwrites it instead of adding a
+        # duplicate.
+        ids.append(get_doc_id(type_, d))
         text_list.append(d.page_content)
         metadatas.append({
             **d.metadata,
@@ -119,48 +359,221 @@ def add_docs(type_, docs):
             'saved_at': timestamp,
         })
 
-    docs_collection = get_docs_collection()
-    docs_collection.add(
-        documents=text_list,
-        ids=ids,
-        metadatas=metadatas,
-    )
-    client.persist()
+    ids, text_list, embeddings, metadatas = \
+        dedupe_by_id(ids, text_list, embeddings, metadatas)
 
+    _upsert_collection("docs", ids, text_list, embeddings, metadatas)
 
-def query_docs(query_list, n_results=10):
-    if not isinstance(query_list, list):
-        query_list = [query_list]
 
-    docs_collection = get_docs_collection()
-    if docs_collection.count() <= 0:
-        return []
+def query_docs(query_list, n_results=10, query_embeddings=None):
+    """
+    Returns the results of the query, or a list of results for each query if
+    `query_list` is a list.
+    """
+    return _query_collection(
+        "docs", query_list,
+        n_results=n_results, query_embeddings=query_embeddings,
+    )
 
-    results = docs_collection.query(
-        query_texts=query_list,
-        n_results=n_results,
+
+@db_operation
+def get_doc_ids_by_type(type_):
+    if collection_registry.is_empty("docs"):
+        return []
+    docs_collection = get_docs_collection()
+    results = docs_collection.get(
+        where={'_type': type_},
+        include=[],
     )
+    return results['ids']
 
-    return [
-        {
-            'id': doc_id,
-            'document': document,
-            'metadata': metadata,
-            'distance': distance,
-        }
-        for doc_id, document, metadata, distance
-        in zip(
-            results['ids'][0],
-            (results['documents'] or [])[0],
-            (results['metadatas'] or [])[0],
-            (results['distances'] or [])[0],
-        )
-    ]
+
+@db_operation
+def delete_docs_by_ids(ids):
+    if not ids:
+        return
+    docs_collection = get_docs_collection()
+    docs_collection.delete(ids=ids)
+    collection_registry.mark_deleted("docs")
+    persist_scheduler.mark_dirty(len(ids))
 
 
+@db_operation
 def delete_docs_by_type(type_):
     docs_collection = get_docs_collection()
     docs_collection.delete(
         where={'_type': type_}
     )
-    client.persist()
+    collection_registry.mark_deleted("docs")
+    persist_scheduler.mark_dirty()
+
+
+# Async data access.
+#
+# Embeddings are requested with the async OpenAI client, and the blocking
+# vector store operations run on a bounded executor, so that none of them
+# stall the event loop.
+
+_db_executor: Union[ThreadPoolExecutor, None] = None
+_embedding_semaphores = {}
+
+
+def get_db_executor() -> ThreadPoolExecutor:
+    global _db_executor
+    if _db_executor is None:
+        _db_executor = ThreadPoolExecutor(
+            max_workers=Config.chromadb.db_executor_max_workers,
+            thread_name_prefix='chromadb',
+        )
+    return _db_executor
+
+
+def _get_embedding_semaphore() -> asyncio.Semaphore:
+    # Semaphores are bound to the event loop they are first used on.
+    loop = asyncio.get_event_loop()
+    semaphore = _embedding_semaphores.get(loop)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(
+            Config.chromadb.max_concurrent_embedding_requests)
+        _embedding_semaphores[loop] = semaphore
+    return semaphore
+
+
+async def run_in_db_executor(func: Callable[..., Any], *args, **kwargs):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        get_db_executor(),
+        functools.partial(func, *args, **kwargs),
+    )
+
+
+async def aembed_texts(texts: List[str]) -> List[List[float]]:
+    function_type = Config.chromadb.embedding_function_type
+    model_name = Config.chromadb.embedding_function_model_name
+    if function_type != 'openai':
+        raise NotImplementedError(f'embedding_function_type: {function_type}')
+
+    if not texts:
+        return []
+
+    cache = get_embedding_cache()
+    if cache is None:
+        return await _aembed_texts_openai(texts, model_name)
+
+    embeddings = cache.get_many(model_name, texts)
+    missing = [i for i, e in enumerate(embeddings) if e is None]
+    if missing:
+        missing_texts = [texts[i] for i in missing]
+        new_embeddings = cache.set_many(
+            model_name, missing_texts,
+            await _aembed_texts_openai(missing_texts, model_name),
+        )
+        for i, embedding in zip(missing, new_embeddings):
+            embeddings[i] = embedding
+    return embeddings  # type: ignore
+
+
+async def _aembed_texts_openai(
+    texts: List[str], model_name: str
+) -> List[List[float]]:
+    # Same preprocessing as chromadb's OpenAIEmbeddingFunction, so that
+    # embeddings do not depend on which path produced them.
+    texts = [t.replace("\n", " ") for t in texts]
+
+    async with _get_embedding_semaphore():
+        response = await openai.Embedding.acreate(
+            api_key=Config.openai_api_key,
+            model=model_name,
+            input=texts,
+        )
+
+    data = sorted(response["data"], key=lambda e: e["index"])
+    return [result["embedding"] for result in data]
+
+
+async def aadd_memory(text_list):
+    if not isinstance(text_list, list):
+        text_list = [text_list]
+    embeddings = await aembed_texts(text_list)
+    return await run_in_db_executor(
+        add_memory, text_list, embeddings=embeddings)
+
+
+async def aquery_memory(query_list, n_results=10):
+    """
+    Returns the results of the query, or a list of results for each query if
+    `query_list` is a list. All queries are embedded in one request.
+    """
+    is_single_query = not isinstance(query_list, list)
+    queries = [query_list] if is_single_query else query_list
+    # Do not pay for embedding the queries if there is nothing to search.
+    if await run_in_db_executor(is_collection_empty, "memory"):
+        return [] if is_single_query else [[] for _ in queries]
+    query_embeddings = await aembed_texts(queries)
+    return await run_in_db_executor(
+        query_memory, query_list,
+        n_results=n_results, query_embeddings=query_embeddings,
+    )
+
+
+async def adelete_memory(ids):
+    return await run_in_db_executor(delete_memory, ids)
+
+
+async def aadd_docs(type_, docs):
+    embeddings = await aembed_texts([d.page_content for d in docs])
+    return await run_in_db_executor(
+        add_docs, type_, docs, embeddings=embeddings)
+
+
+async def aquery_docs(query_list, n_results=10):
+    """
+    Returns the results of the query, or a list of results for each query if
+    `query_list` is a list. All queries are embedded in one request.
+    """
+    is_single_query = not isinstance(query_list, list)
+    queries = [query_list] if is_single_query else query_list
+    # Do not pay for embedding the queries if there is nothing to search.
+    if await run_in_db_executor(is_collection_empty, "docs"):
+        return [] if is_single_query else [[] for _ in queries]
+    query_embeddings = await aembed_texts(queries)
+    return await run_in_db_executor(
+        query_docs, query_list,
+        n_results=n_results, query_embeddings=query_embeddings,
+    )
+
+
+async def adelete_docs_by_type(type_):
+    return await run_in_db_executor(delete_docs_by_type, type_)
+
+
+async def aquery_memory_and_docs(
+    query_list, memory_n_results=10, docs_n_results=10
+):
+    """
+    Searches both memory and docs with the queries embedded once. Returns
+    `(memory_results, docs_results)`, each shaped like the result of
+    `query_memory`/`query_docs`.
+
+    The searches themselves still run one after the other, since every
+    vector store operation holds the db lock.
+    """
+    is_single_query = not isinstance(query_list, list)
+    queries = [query_list] if is_single_query else query_list
+
+    memory_is_empty = await run_in_db_executor(is_collection_empty, "memory")
+    docs_is_empty = await run_in_db_executor(is_collection_empty, "docs")
+    if memory_is_empty and docs_is_empty:
+        empty = [] if is_single_query else [[] for _ in queries]
+        return empty, empty
+
+    query_embeddings = await aembed_texts(queries)
+    memory_results = await run_in_db_executor(
+        query_memory, query_list,
+        n_results=memory_n_results, query_embeddings=query_embeddings,
+    )
+    docs_results = await run_in_db_executor(
+        query_docs, query_list,
+        n_results=docs_n_results, query_embeddings=query_embeddings,
+    )
+    return memory_results, docs_results
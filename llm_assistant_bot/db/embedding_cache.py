@@ -0,0 +1,255 @@
+from typing import Dict, List, Union, Tuple
+
+import os
+import time
+import array
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+from ..config import Config
+
+
+def get_text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache():
+    """
+    Disk-backed embedding cache keyed by (model name, sha256 of the text),
+    with an in-memory LRU in front of it.
+
+    Embeddings are stored as float32 in both tiers, so a text gets the same
+    embedding whichever tier serves it.
+    """
+
+    def __init__(self, path: str, max_entries: int, memory_max_entries: int):
+        self.path = path
+        self.max_entries = max_entries
+        self.memory_max_entries = memory_max_entries
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._memory: 'OrderedDict[Tuple[str, str], List[float]]' = \
+            OrderedDict()
+
+        dir_path = os.path.dirname(path)
+        if dir_path:
+            os.makedirs(dir_path, exist_ok=True)
+        self._conn = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                last_used_at REAL NOT NULL,
+                PRIMARY KEY (model, text_hash)
+            )
+        ''')
+        self._conn.execute('''
+            CREATE INDEX IF NOT EXISTS embeddings_last_used_at
+            ON embeddings (last_used_at)
+        ''')
+        self._disk_entries = self._count()
+
+    def get_many(
+        self, model: str, texts: List[str]
+    ) -> List[Union[List[float], None]]:
+        keys = [(model, get_text_hash(t)) for t in texts]
+        results: List[Union[List[float], None]] = [None] * len(keys)
+        now = time.time()
+
+        with self._lock:
+            missing_in_memory: Dict[str, List[int]] = {}
+            for i, key in enumerate(keys):
+                embedding = self._memory.get(key)
+                if embedding is not None:
+                    self._memory.move_to_end(key)
+                    results[i] = embedding
+                else:
+                    missing_in_memory.setdefault(key[1], []).append(i)
+
+            if missing_in_memory:
+                found = self._get_from_disk(model, list(missing_in_memory))
+                for text_hash, embedding in found.items():
+                    for i in missing_in_memory[text_hash]:
+                        results[i] = embedding
+                    self._remember((model, text_hash), embedding)
+                if found:
+                    self._conn.executemany(
+                        'UPDATE embeddings SET last_used_at = ? '
+                        'WHERE model = ? AND text_hash = ?',
+                        [(now, model, h) for h in found],
+                    )
+
+            hits = sum(1 for r in results if r is not None)
+            self.hits += hits
+            self.misses += len(results) - hits
+
+        return results
+
+    def set_many(
+        self, model: str, texts: List[str], embeddings: List[List[float]]
+    ) -> List[List[float]]:
+        """
+        Caches the embeddings, and returns them as they are stored, which
+        is what later hits will return.
+        """
+        now = time.time()
+        rows = []
+        stored_embeddings = []
+        with self._lock:
+            for text, embedding in zip(texts, embeddings):
+                key = (model, get_text_hash(text))
+                stored_embedding = array.array('f', embedding)
+                stored_embeddings.append(stored_embedding.tolist())
+                self._remember(key, stored_embeddings[-1])
+                rows.append((
+                    model, key[1],
+                    stored_embedding.tobytes(),
+                    now,
+                ))
+            self._conn.execute('BEGIN')
+            try:
+                self._conn.executemany(
+                    'INSERT OR REPLACE INTO embeddings '
+                    '(model, text_hash, embedding, last_used_at) '
+                    'VALUES (?, ?, ?, ?)',
+                    rows,
+                )
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+            self._disk_entries += len(rows)
+            if self._disk_entries > self.max_entries:
+                self._evict()
+        return stored_embeddings
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'path': self.path,
+                'entries': self._count(),
+                'max_entries': self.max_entries,
+                'memory_entries': len(self._memory),
+                'memory_max_entries': self.memory_max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._conn.execute('DELETE FROM embeddings')
+            self._conn.execute('VACUUM')
+            self._disk_entries = 0
+            self.hits = 0
+            self.misses = 0
+
+    def _count(self) -> int:
+        return self._conn.execute(
+            'SELECT COUNT(*) FROM embeddings').fetchone()[0]
+
+    def _get_from_disk(
+        self, model: str, text_hashes: List[str]
+    ) -> Dict[str, List[float]]:
+        found = {}
+        # Stay below SQLite's limit on the number of bound parameters.
+        for i in range(0, len(text_hashes), 500):
+            chunk = text_hashes[i:i + 500]
+            placeholders = ', '.join('?' * len(chunk))
+            rows = self._conn.execute(
+                'SELECT text_hash, embedding FROM embeddings '
+                f'WHERE model = ? AND text_hash IN ({placeholders})',
+                [model, *chunk],
+            ).fetchall()
+            for text_hash, blob in rows:
+                found[text_hash] = array.array('f', blob).tolist()
+        return found
+
+    def _remember(self, key: Tuple[str, str], embedding: List[float]):
+        self._memory[key] = embedding
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_max_entries:
+            self._memory.popitem(last=False)
+
+    def _evict(self):
+        # `_disk_entries` over-counts replaced rows, so re-count first.
+        self._disk_entries = self._count()
+        overflow = self._disk_entries - self.max_entries
+        if overflow <= 0:
+            return
+        self._conn.execute(
+            'DELETE FROM embeddings WHERE rowid IN ('
+            'SELECT rowid FROM embeddings ORDER BY last_used_at LIMIT ?)',
+            (overflow,),
+        )
+        self._disk_entries -= overflow
+
+
+_embedding_cache: Union[EmbeddingCache, None] = None
+_embedding_cache_lock = threading.Lock()
+
+
+def get_embedding_cache() -> Union[EmbeddingCache, None]:
+    global _embedding_cache
+    if not Config.chromadb.embedding_cache_enabled:
+        return None
+    if _embedding_cache is None:
+        with _embedding_cache_lock:
+            if _embedding_cache is None:
+                _embedding_cache = EmbeddingCache(
+                    path=Config.chromadb.embedding_cache_path,
+                    max_entries=Config.chromadb.embedding_cache_max_entries,
+                    memory_max_entries=Config.chromadb.embedding_cache_memory_max_entries,
+                )
+    return _embedding_cache
+
+
+class CachedEmbeddingFunction():
+    """
+    Wraps a chromadb embedding function so that only texts missing from the
+    embedding cache are sent to it.
+    """
+
+    def __init__(self, embedding_function, model_name: str):
+        self.embedding_function = embedding_function
+        self.model_name = model_name
+
+    def __call__(self, texts: List[str]) -> List[List[float]]:
+        cache = get_embedding_cache()
+        if cache is None:
+            return self.embedding_function(texts)
+
+        embeddings = cache.get_many(self.model_name, texts)
+        missing = [i for i, e in enumerate(embeddings) if e is None]
+        if missing:
+            missing_texts = [texts[i] for i in missing]
+            new_embeddings = cache.set_many(
+                self.model_name, missing_texts,
+                self.embedding_function(missing_texts),
+            )
+            for i, embedding in zip(missing, new_embeddings):
+                embeddings[i] = embedding
+        return embeddings  # type: ignore
+
+
+def embedding_cache_stats():
+    cache = get_embedding_cache()
+    if cache is None:
+        return None
+    return cache.stats()
+
+
+def clear_embedding_cache():
+    cache = get_embedding_cache()
+    if cache is not None:
+        cache.clear()
@@ -0,0 +1,199 @@
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Set, Union
+
+import asyncio
+import logging
+
+from ..config import Config
+from .chromadb import (
+    aembed_texts,
+    run_in_db_executor,
+    add_docs,
+    get_doc_id,
+    get_doc_ids_by_type,
+    delete_docs_by_ids,
+)
+
+logger = logging.getLogger("ingestion")
+
+_END = object()
+
+
+async def aingest_docs(
+    type_: str,
+    docs: Iterable[Any],
+    text_splitter: Any = None,
+    batch_size: Union[int, None] = None,
+    max_concurrency: Union[int, None] = None,
+    max_retries: Union[int, None] = None,
+    progress_callback: Union[Callable[[Dict[str, int]], Any], None] = None,
+) -> Dict[str, int]:
+    """
+    Splits, embeds and inserts documents in bounded batches while consuming
+    `docs` lazily, so memory use does not grow with the size of the corpus.
+    A batch that still fails after `max_retries` retries is skipped and
+    counted in the returned stats instead of failing the whole import.
+    """
+    if batch_size is None:
+        batch_size = Config.chromadb.ingestion_batch_size
+    if max_concurrency is None:
+        max_concurrency = Config.chromadb.ingestion_max_concurrency
+    if max_retries is None:
+        max_retries = Config.chromadb.ingestion_max_retries
+
+    stats = {
+        'docs': 0,
+        'chunks': 0,
+        'batches_done': 0,
+        'batches_failed': 0,
+        'chunks_added': 0,
+        'chunks_failed': 0,
+    }
+
+    def report_progress():
+        logger.info(
+            f"Ingesting '{type_}': {stats['docs']} docs read, "
+            f"{stats['chunks_added']}/{stats['chunks']} chunks added, "
+            f"{stats['batches_failed']} batch(es) failed.")
+        if progress_callback:
+            progress_callback(dict(stats))
+
+    async def process_batch(batch: List[Any]):
+        for attempt in range(max_retries + 1):
+            try:
+                embeddings = await aembed_texts(
+                    [d.page_content for d in batch])
+                await run_in_db_executor(
+                    add_docs, type_, batch, embeddings=embeddings)
+                stats['batches_done'] += 1
+                stats['chunks_added'] += len(batch)
+                break
+            except Exception as e:
+                if attempt >= max_retries:
+                    logger.error(
+                        f"Giving up on a batch of {len(batch)} chunks of "
+                        f"'{type_}' after {attempt + 1} attempts: {e}")
+                    stats['batches_failed'] += 1
+                    stats['chunks_failed'] += len(batch)
+                    break
+                delay = 2 ** attempt
+                logger.warning(
+                    f"Failed to ingest a batch of '{type_}' ({e}), "
+                    f"retrying in {delay}s.")
+                await asyncio.sleep(delay)
+        report_progress()
+
+    loop = asyncio.get_event_loop()
+    docs_iter: Iterator[Any] = iter(docs)
+    pending: Set[asyncio.Future] = set()
+    batch: List[Any] = []
+
+    async def submit(batch: List[Any]):
+        nonlocal pending
+        while len(pending) >= max_concurrency:
+            _, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED)
+        pending.add(asyncio.ensure_future(process_batch(batch)))
+
+    try:
+        while True:
+            # Lazy loaders may block (e.g. fetching the next page), so
+            # advance the iterator off the event loop.
+            doc = await loop.run_in_executor(None, next, docs_iter, _END)
+            if doc is _END:
+                break
+            stats['docs'] += 1
+
+            chunks = text_splitter.split_documents([doc]) \
+                if text_splitter else [doc]
+            for chunk in chunks:
+                stats['chunks'] += 1
+                batch.append(chunk)
+                if len(batch) >= batch_size:
+                    await submit(batch)
+                    batch = []
+
+        if batch:
+            await submit(batch)
+        if pending:
+            await asyncio.wait(pending)
+    finally:
+        # If reading the docs failed (or the import was cancelled), do not
+        # leave batches running in the background.
+        for future in pending:
+            future.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    return stats
+
+
+def ingest_docs(type_: str, docs: Iterable[Any], **kwargs) -> Dict[str, int]:
+    """
+    Sync version of `aingest_docs`, for use in the console.
+    """
+    loop = asyncio.get_event_loop()
+    return loop.run_until_complete(aingest_docs(type_, docs, **kwargs))
+
+
+async def aresync_docs(
+    type_: str,
+    docs: Iterable[Any],
+    text_splitter: Any = None,
+    **kwargs,
+) -> Dict[str, int]:
+    """
+    Brings the docs of `type_` in line with `docs`: only chunks that are new
+    or changed are embedded and inserted, chunks that are no longer present
+    are deleted, and unchanged chunks are left alone. Chunks are identified
+    by a hash of their content and metadata.
+    """
+    existing_ids = set(
+        await run_in_db_executor(get_doc_ids_by_type, type_))
+    seen_ids: Set[str] = set()
+    unchanged = 0
+
+    def get_changed_chunks():
+        nonlocal unchanged
+        for doc in docs:
+            chunks = text_splitter.split_documents([doc]) \
+                if text_splitter else [doc]
+            for chunk in chunks:
+                doc_id = get_doc_id(type_, chunk)
+                if doc_id in seen_ids:
+                    continue
+                seen_ids.add(doc_id)
+                if doc_id in existing_ids:
+                    unchanged += 1
+                    continue
+                yield chunk
+
+    stats = await aingest_docs(type_, get_changed_chunks(), **kwargs)
+
+    # Only delete vanished chunks if everything new made it in, so a failed
+    # sync never leaves the docs worse off than before.
+    deleted_ids = list(existing_ids - seen_ids)
+    if stats['batches_failed'] == 0:
+        for i in range(0, len(deleted_ids), 500):
+            await run_in_db_executor(
+                delete_docs_by_ids, deleted_ids[i:i + 500])
+        stats['chunks_deleted'] = len(deleted_ids)
+    else:
+        logger.warning(
+            f"Not deleting {len(deleted_ids)} vanished chunk(s) of '{type_}' "
+            "since some batches failed.")
+        stats['chunks_deleted'] = 0
+    stats['chunks_unchanged'] = unchanged
+
+    logger.info(
+        f"Re-synced '{type_}': {stats['chunks_added']} added, "
+        f"{stats['chunks_unchanged']} unchanged, "
+        f"{stats['chunks_deleted']} deleted.")
+    return stats
+
+
+def resync_docs(type_: str, docs: Iterable[Any], **kwargs) -> Dict[str, int]:
+    """
+    Sync version of `aresync_docs`, for use in the console.
+    """
+    loop = asyncio.get_event_loop()
+    return loop.run_until_complete(aresync_docs(type_, docs, **kwargs))
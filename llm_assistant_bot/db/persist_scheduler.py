@@ -0,0 +1,83 @@
+from typing import Any, Callable, Union
+
+import atexit
+import logging
+import threading
+
+logger = logging.getLogger("persist_scheduler")
+
+
+class PersistScheduler():
+    """
+    Coalesces mutations of the vector store and persists them in one go,
+    once `max_delay` seconds have passed since the first unpersisted
+    mutation or `max_pending` mutations have piled up, whichever comes
+    first. In 'immediate' mode every mutation is persisted right away.
+    """
+
+    def __init__(
+        self,
+        persist: Callable[[], None],
+        get_mode: Callable[[], str],
+        get_max_delay: Callable[[], float],
+        get_max_pending: Callable[[], int],
+        lock: Any = None,
+    ):
+        self._persist = persist
+        self._get_mode = get_mode
+        self._get_max_delay = get_max_delay
+        self._get_max_pending = get_max_pending
+
+        # Should be the same lock that guards the store, so that persisting
+        # from the timer thread can't deadlock with a mutation that marks the
+        # store dirty.
+        self._lock = lock or threading.RLock()
+        self._pending = 0
+        self._timer: Union[threading.Timer, None] = None
+
+        atexit.register(self.flush)
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def mark_dirty(self, mutations: int = 1):
+        mode = self._get_mode()
+        with self._lock:
+            self._pending += mutations
+
+            if mode == 'immediate':
+                self.flush()
+            elif mode == 'batched':
+                if self._pending >= self._get_max_pending():
+                    self.flush()
+                elif self._timer is None:
+                    self._timer = threading.Timer(
+                        self._get_max_delay(), self._flush_from_timer)
+                    self._timer.daemon = True
+                    self._timer.start()
+            else:
+                raise ValueError(f'Invalid persist mode: {mode}')
+
+    def flush(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self._pending <= 0:
+                return
+            pending = self._pending
+            self._pending = 0
+            try:
+                self._persist()
+            except Exception:
+                # Keep the mutations pending so the next flush retries.
+                self._pending += pending
+                raise
+            logger.debug(f"Persisted {pending} mutation(s).")
+
+    def _flush_from_timer(self):
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error(f"Failed to persist the vector store: {e}")
@@ -9,24 +9,29 @@ from slack_sdk.web.async_client import AsyncWebClient
 from langchain.memory import ConversationBufferWindowMemory
 import commonmarkslack
 
-from ..agent import Agent
+from ..agent import get_agent_runtime
+from .thread_cache import ThreadCache
+from .user_directory import get_user_directory
+from .status_updater import StatusUpdater
+from .run_scheduler import RunScheduler, RunQueueFullError
+from .job_queue import get_job_queue
 
 from ..config import Config
 
 TYPING_MESSAGE_TEXT = "_(thinking...)_"
+# Starts like the other status messages, so that the history filter also
+# skips a reply that is still being streamed.
+STREAMING_MESSAGE_PREFIX = "_(typing...)_\n"
+BUSY_MESSAGE_TEXT = \
+    "_⚠ I'm handling too many requests right now, please try again later._"
 
 
 def get_slack_bot_app():
     logger = logging.getLogger("slack_bot")
 
-    # cached_agent = None
-
-    # def get_agent() -> Agent:
-    #     # nonlocal cached_agent
-    #     # if cached_agent is None:
-    #     #     cached_agent = Agent()
-    #     # return cached_agent
-    #     return Agent()
+    # Build the shared agent runtime up front so that the first message does
+    # not pay for it.
+    get_agent_runtime()
 
     cached_bot_info = None
 
@@ -36,6 +41,29 @@ def get_slack_bot_app():
             cached_bot_info = await client.auth_test()
         return cached_bot_info
 
+    # With several worker processes, events of a thread may arrive at any of
+    # them, so the cache has to be shared through SQLite.
+    is_multi_process = Config.slack.workers > 1
+    thread_cache = ThreadCache(
+        max_threads=Config.slack.thread_cache_max_threads,
+        path=(
+            Config.slack.thread_cache_path
+            if Config.slack.thread_cache_persist or is_multi_process
+            else None
+        ),
+        shared=is_multi_process,
+    )
+
+    user_directory = get_user_directory()
+
+    run_scheduler = RunScheduler(
+        max_concurrent_runs=Config.slack.max_concurrent_runs,
+        max_concurrent_runs_per_channel=Config.slack.max_concurrent_runs_per_channel,
+        max_queue_size=Config.slack.max_queued_runs,
+    )
+
+    job_queue = get_job_queue()
+
     app = AsyncApp(
         token=Config.slack.bot_user_oauth_token,
         signing_secret=Config.slack.signing_secret,
@@ -46,15 +74,52 @@ def get_slack_bot_app():
         pass
 
     @app.event("message")
-    async def message(event, client: AsyncWebClient):
+    async def message(event, body, client: AsyncWebClient):
+        # Slack retries events that it thinks were not delivered, handle each
+        # only once.
+        if job_queue.is_duplicate([
+            body.get('event_id'),
+            event.get('client_msg_id'),
+        ]):
+            logger.info(f"Ignoring duplicate event {body.get('event_id')}.")
+            return
+
+        # Keep cached threads up to date with every message, including the
+        # ones from the bot itself.
+        thread_cache.handle_message_event(event)
+
         if 'bot_id' in event:
             return
 
         if 'subtype' in event:
             subtype = event['subtype']
-            if subtype == 'message_changed':
+            if subtype in ('message_changed', 'message_deleted'):
                 return
 
+        # In channels or group direct messages, do not reply if the bot
+        # isn't mentioned. Checked before queueing, so that such messages do
+        # not take up workers or queue slots.
+        bot_info = await get_bot_info(client)
+        channel_id = event.get("channel", '')
+        if (
+            not channel_id.startswith('D')
+            and f"<@{bot_info['user_id']}>" not in (event.get("text") or '')
+        ):
+            return
+
+        # Return (and so acknowledge the event) right away, the agent run is
+        # done by a worker.
+        if not job_queue.submit(handle_message, event, client):
+            # The event is already marked as seen, so tell the user instead
+            # of leaving the message unanswered.
+            await client.chat_postMessage(
+                channel=channel_id,
+                # Should always reply in the thread.
+                thread_ts=event.get("ts"),
+                text=BUSY_MESSAGE_TEXT,
+            )
+
+    async def handle_message(event, client: AsyncWebClient):
         bot_info = await get_bot_info(client)
         bot_id = bot_info["user_id"]
         bot_mention = f"<@{bot_id}>"
@@ -67,16 +132,10 @@ def get_slack_bot_app():
         # If message is not in a thread, thread_ts will be None.
         thread_ts = event.get("thread_ts", message_ts)
 
-        is_direct_message = True
-
         # Check if this is a direct message by checking if the channel ID
-        # starts with 'D'
-        if not channel_id.startswith('D'):
-            is_direct_message = False
-            # In channels or group direct messages, do not reply if the bot
-            # isn't mentioned.
-            if f"<@{bot_id}>" not in text:
-                return
+        # starts with 'D'. Messages in channels that do not mention the bot
+        # have been filtered out before queueing.
+        is_direct_message = channel_id.startswith('D')
 
         # Send a 'thinking...' message to indicate that the bot is working.
         # This message will also be used to report the execution status of
@@ -89,23 +148,36 @@ def get_slack_bot_app():
             )
         )
 
-        # A function to update the 'thinking...' message to report the current
-        # status.
-        async def update_status_async(status):
+        # A function to update the text of the 'thinking...' message.
+        async def update_typing_message_async(text):
             typing_message = await send_typing_message_task
             message_ts = typing_message['ts']
             return await client.chat_update(
                 channel=channel_id,
                 ts=message_ts,  # type: ignore
-                text=f'_({status})_'
+                text=text,
             )
 
+        # Status updates and the streamed reply share one updater, so that
+        # they are sent in order and throttled together.
+        typing_message_updater = StatusUpdater(
+            update_typing_message_async,
+            interval=Config.slack.status_update_interval,
+        )
+
         # A function to update the 'thinking...' message to report the current
         # status, with no async.
         def update_status(status):
-            return asyncio.create_task(
-                update_status_async(status)
-            )
+            typing_message_updater.update(f'_({status})_')
+
+        markdown_converter = IncrementalMarkdownToSlackConverter()
+
+        # A callback function that will be called with the partial final
+        # reply while it is being streamed.
+        def final_reply_callback(partial_reply):
+            typing_message_updater.update(
+                STREAMING_MESSAGE_PREFIX
+                + markdown_converter.convert(partial_reply) + ' ...')
 
         memorized = []
 
@@ -129,79 +201,87 @@ def get_slack_bot_app():
                 if len(input) > 40:
                     input = f"<{input}|{input[:40] + '...'}>"
                 update_status(f'Browsing "{input}"...')
+            elif tool_name == 'browser_fetch_pages':
+                update_status(f'Browsing {len(input.split())} pages...')
 
-        agent = Agent(use_tool_callback=use_tool_callback)
+        agent_runtime = get_agent_runtime()
 
         def get_info_message(time_elapsed):
-            return f"\n_(Model: {agent.llm.model_name}, time elapsed: {time_elapsed:.1f}s)_"
+            return f"\n_(Model: {agent_runtime.llm.model_name}, time elapsed: {time_elapsed:.1f}s)_"
 
         ai_started_at = None
+        run_job = None
         try:
-            thread_replies = await client.conversations_replies(
-                channel=channel_id,
-                ts=thread_ts
+            # Wait for a free slot before doing any expensive work.
+            run_job = await run_scheduler.acquire(
+                channel_id,
+                user_id,
+                on_queue_position=lambda position: update_status(
+                    f'Waiting in queue (position {position})...'),
             )
-
-            user_info_cache = {}
-
-            async def get_user_info(user_id):
-                if user_id not in user_info_cache:
-                    user_info_cache[user_id] = \
-                        await client.users_info(user=user_id)
-                return user_info_cache[user_id]
-
-            async def replace_user_mentions(msg):
-                # Find all mentions
-                mention_ids = re.findall(r"<@([a-zA-Z0-9]+)>", msg)
-
-                # Get user info for each mention
-                user_infos = await asyncio.gather(
-                    *(get_user_info(user_id) for user_id in mention_ids)
+            if run_job.queue_position is not None:
+                update_status('thinking...')
+
+            thread_messages = await thread_cache.get_thread_messages(
+                client, channel_id, thread_ts)
+
+            # Resolve every user that is needed to build the history (authors
+            # and mentions) in one concurrent pass.
+            needed_user_ids = [event['user']]
+            for message in thread_messages:
+                if 'bot_id' not in message:
+                    needed_user_ids.append(message['user'])
+                needed_user_ids += re.findall(
+                    r"<@([a-zA-Z0-9]+)>", message.get('text', ''))
+            needed_user_ids = [
+                u for u in needed_user_ids if u and u != bot_id]
+            users = await user_directory.get_users(client, needed_user_ids)
+
+            def replace_user_mentions(msg):
+                # Replace each mention with the name of the user
+                return re.sub(
+                    r"<@([a-zA-Z0-9]+)>",
+                    lambda m: (
+                        f"@{users[m.group(1)]['real_name']}"
+                        if m.group(1) in users else m.group(0)
+                    ),
+                    msg,
                 )
 
-                # Create a mapping from mention to user info
-                mention_id_to_name = {
-                    f"<@{user_id}>": f"@{info['user']['real_name']}"
-                    for user_id, info in zip(mention_ids, user_infos)
-                }
-
-                # Replace each mention with its corresponding user info
-                for user_id, user_name in mention_id_to_name.items():
-                    msg = msg.replace(user_id, user_name)
-
-                return msg
-
             history = []
-            for message in thread_replies.get('messages', []):
+            for message in thread_messages:
                 if message['ts'] == message_ts:
                     # Ignore the current message that triggered this event.
                     continue
 
                 if 'bot_id' in message:
+                    # Status messages and replies that are still being
+                    # streamed start with '_('.
                     if (
-                        message['user'] == bot_id
+                        message.get('user') == bot_id
                         and not message['text'].startswith('_(')
                     ):
                         msg = message['text']
-                        msg = await replace_user_mentions(msg)
+                        msg = replace_user_mentions(msg)
                         history.append({
                             'from': 'bot',
+                            'ts': message['ts'],
                             'message': msg,
                         })
                     # Messages not from this bot are ignored.
 
                 else:
-                    user_info = await get_user_info(message['user'])
+                    user = users[message['user']]
                     msg = message['text']
                     msg = message['text'].replace(
                         bot_mention, bot_mention_replacement)
-                    msg = await replace_user_mentions(msg)
+                    msg = replace_user_mentions(msg)
                     history.append({
                         'from': 'user',
+                        'ts': message['ts'],
                         'user_id': message['user'],
-                        # 'user_id': user_info['user']['id'],
-                        'user_name': user_info['user']['real_name'],
-                        # 'user_display_name': user_info['user']['profile']['display_name'],
+                        'user_name': user['real_name'],
+                        # 'user_display_name': user['profile']['display_name'],
                         'message': msg,
                     })
 
@@ -210,29 +290,32 @@ def get_slack_bot_app():
                 json.dumps(history, indent=2, ensure_ascii=False)
             )
 
-            memory = agent.get_new_memory()
+            memory_messages = []
             for h in history:
                 if h['from'] == 'user':
-                    memory.chat_memory.add_user_message(
-                        f"@{h['user_name']}: " + h['message']
-                    )
+                    memory_messages.append((
+                        h['ts'], 'human',
+                        f"@{h['user_name']}: " + h['message'],
+                    ))
                 if h['from'] == 'bot':
                     message = h['message']
                     message = re.sub(r'\n_\([^()]+\)_$', '', message)
                     message = message.strip()
-                    memory.chat_memory.add_ai_message(message)
+                    memory_messages.append((h['ts'], 'ai', message))
 
-            memory.prune()
-            ai_started_at = time.time()
-            agent_executor = agent.get_agent_executor(
-                memory=memory
+            memory = await agent_runtime.abuild_memory(
+                memory_messages,
+                conversation_key=f"slack:{channel_id}:{thread_ts}",
             )
+            ai_started_at = time.time()
 
-            user_info = await get_user_info(event['user'])
-            user_name = user_info['user']['real_name']
-            reply = await agent_executor.arun(
+            user_name = users[event['user']]['real_name']
+            reply = await agent_runtime.arun(
                 f"@{user_name}: {text}".replace(bot_mention,
-                                                bot_mention_replacement)
+                                                bot_mention_replacement),
+                memory=memory,
+                use_tool_callback=use_tool_callback,
+                final_reply_callback=final_reply_callback,
             )
             ai_ended_at = time.time()
 
@@ -254,6 +337,13 @@ def get_slack_bot_app():
                 mrkdwn=True,
                 link_names=True,
             )
+        except RunQueueFullError as e:
+            logger.warning(f"Rejected a message from {user_id}: {e}")
+            await client.chat_postMessage(
+                channel=channel_id,
+                thread_ts=message_ts,  # Should always reply in the thread.
+                text=BUSY_MESSAGE_TEXT,
+            )
         except Exception as e:
             time_elapsed = 0
             if ai_started_at:
@@ -279,6 +369,9 @@ def get_slack_bot_app():
 
             raise exception from e
         finally:
+            if run_job:
+                run_scheduler.release(run_job)
+            await typing_message_updater.close()
             typing_message = await send_typing_message_task
             await client.chat_delete(
                 channel=channel_id,
@@ -299,6 +392,36 @@ def convert_markdown_to_slack(text):
     return '```'.join(texts)
 
 
+class IncrementalMarkdownToSlackConverter():
+    """
+    Converts a growing Markdown text, such as a reply that is being streamed,
+    without converting the whole text again each time: paragraphs that are
+    complete (and not inside a code fence) are converted once and kept.
+    """
+
+    def __init__(self):
+        self._converted_source = ''
+        self._converted_text = ''
+
+    def convert(self, text):
+        if not text.startswith(self._converted_source):
+            self._converted_source = ''
+            self._converted_text = ''
+
+        rest = text[len(self._converted_source):]
+        boundary = rest.rfind('\n\n')
+        if boundary >= 0:
+            complete = rest[:boundary]
+            source = self._converted_source + rest[:boundary + 2]
+            if source.count('```') % 2 == 0:
+                self._converted_source = source
+                self._converted_text += \
+                    convert_markdown_to_slack(complete).rstrip('\n') + '\n\n'
+                rest = rest[boundary + 2:]
+
+        return self._converted_text + convert_markdown_to_slack(rest)
+
+
 def _convert_markdown_to_slack(text):
     parser = commonmarkslack.Parser()
     ast = parser.parse(text)
@@ -0,0 +1,186 @@
+from typing import Any, Awaitable, Callable, Iterable, List, Tuple, Union
+
+import os
+import time
+import sqlite3
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+
+from ..config import Config
+
+logger = logging.getLogger("slack_job_queue")
+
+Job = Tuple[Callable[..., Awaitable[Any]], Tuple[Any, ...]]
+
+
+class JobQueue():
+    """
+    Lets event handlers return (and the event be acknowledged) right away,
+    while the actual work is done by a pool of worker tasks.
+
+    Jobs carry dedupe keys (such as the Slack `event_id` and
+    `client_msg_id`), and a job whose key has been seen within `dedupe_ttl`
+    seconds is dropped, so events that Slack retries are only handled once.
+    If `dedupe_path` is given, seen keys are kept in SQLite, so that they are
+    shared by several processes.
+    """
+
+    def __init__(
+        self,
+        num_workers: int,
+        max_size: int,
+        dedupe_ttl: int,
+        dedupe_max_entries: int = 10000,
+        dedupe_path: Union[str, None] = None,
+    ):
+        self.num_workers = num_workers
+        self.max_size = max_size
+        self.dedupe_ttl = dedupe_ttl
+        self.dedupe_max_entries = dedupe_max_entries
+
+        self._seen: 'OrderedDict[str, float]' = OrderedDict()
+        self._conn = None
+        self._lock = threading.Lock()
+        if dedupe_path:
+            dir_path = os.path.dirname(dedupe_path)
+            if dir_path:
+                os.makedirs(dir_path, exist_ok=True)
+            self._conn = sqlite3.connect(
+                dedupe_path, check_same_thread=False, isolation_level=None)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS seen_events (
+                    key TEXT PRIMARY KEY,
+                    seen_at REAL NOT NULL
+                )
+            ''')
+        self._queue: Union['asyncio.Queue[Job]', None] = None
+        self._workers: List[asyncio.Task] = []
+
+    def is_duplicate(self, dedupe_keys: Iterable[Union[str, None]]) -> bool:
+        """
+        Returns True if any of the keys has been seen recently, otherwise
+        records them as seen and returns False.
+        """
+        if self._conn is not None:
+            return self._is_duplicate_shared(dedupe_keys)
+
+        now = time.time()
+        while self._seen:
+            key, seen_at = next(iter(self._seen.items()))
+            if (
+                now - seen_at < self.dedupe_ttl
+                and len(self._seen) <= self.dedupe_max_entries
+            ):
+                break
+            del self._seen[key]
+
+        keys = [k for k in dedupe_keys if k]
+        if any(k in self._seen for k in keys):
+            return True
+        for k in keys:
+            self._seen[k] = now
+        return False
+
+    def _is_duplicate_shared(
+        self, dedupe_keys: Iterable[Union[str, None]]
+    ) -> bool:
+        assert self._conn is not None
+        now = time.time()
+        keys = [k for k in dedupe_keys if k]
+        with self._lock:
+            # Check and record in one write transaction, so two processes
+            # can not both take the same event.
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.execute(
+                    'DELETE FROM seen_events WHERE seen_at < ?',
+                    (now - self.dedupe_ttl,),
+                )
+                is_duplicate = any(
+                    self._conn.execute(
+                        'SELECT 1 FROM seen_events WHERE key = ?', (k,)
+                    ).fetchone()
+                    for k in keys
+                )
+                if not is_duplicate:
+                    self._conn.executemany(
+                        'INSERT OR REPLACE INTO seen_events (key, seen_at) '
+                        'VALUES (?, ?)',
+                        [(k, now) for k in keys],
+                    )
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+        return is_duplicate
+
+    def submit(
+        self, fn: Callable[..., Awaitable[Any]], *args: Any
+    ) -> bool:
+        """
+        Queues `fn(*args)` to be run by a worker. Returns False if the queue
+        is full and the job has been dropped.
+        """
+        self._start_workers()
+        assert self._queue is not None
+        try:
+            self._queue.put_nowait((fn, args))
+        except asyncio.QueueFull:
+            logger.warning(
+                f"Job queue is full ({self.max_size}), dropping a job.")
+            return False
+        return True
+
+    async def close(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._queue = None
+
+    def _start_workers(self):
+        if self._workers:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_size)
+        self._workers = [
+            asyncio.ensure_future(self._work(self._queue))
+            for _ in range(self.num_workers)
+        ]
+
+    async def _work(self, queue: 'asyncio.Queue[Job]'):
+        while True:
+            fn, args = await queue.get()
+            try:
+                await fn(*args)
+            except Exception as e:
+                logger.exception(f"Job failed: {e}")
+            finally:
+                queue.task_done()
+
+
+_job_queue: Union[JobQueue, None] = None
+
+
+def get_job_queue() -> JobQueue:
+    global _job_queue
+    if _job_queue is None:
+        _job_queue = JobQueue(
+            num_workers=(
+                Config.slack.job_workers
+                # One more than the runs the scheduler takes, so that the
+                # next message reaches it and gets rejected.
+                or Config.slack.max_concurrent_runs
+                + Config.slack.max_queued_runs + 1
+            ),
+            max_size=Config.slack.job_queue_max_size,
+            dedupe_ttl=Config.slack.event_dedupe_ttl,
+            # Retried events may arrive at another worker process.
+            dedupe_path=(
+                Config.slack.event_dedupe_path
+                if Config.slack.workers > 1 else None
+            ),
+        )
+    return _job_queue
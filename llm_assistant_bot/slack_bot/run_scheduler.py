@@ -0,0 +1,166 @@
+from typing import Any, Callable, Dict, List, Union
+
+import asyncio
+import logging
+from collections import OrderedDict, deque
+
+logger = logging.getLogger("slack_run_scheduler")
+
+
+class RunQueueFullError(Exception):
+    pass
+
+
+class _Job():
+    def __init__(
+        self,
+        channel: str,
+        user: str,
+        on_queue_position: Union[Callable[[int], Any], None],
+    ):
+        self.channel = channel
+        self.user = user
+        self.on_queue_position = on_queue_position
+        self.queue_position: Union[int, None] = None
+        self.started: Union[asyncio.Future, None] = None
+        self.running = False
+
+
+class RunScheduler():
+    """
+    Limits how many agent runs happen at once, overall and per channel.
+    Runs that can not start right away wait in a queue that is fair across
+    users: users take turns, and each user's runs start in the order they
+    came in. When the queue is full, new runs are rejected with
+    `RunQueueFullError`.
+    """
+
+    def __init__(
+        self,
+        max_concurrent_runs: int,
+        max_concurrent_runs_per_channel: int,
+        max_queue_size: int,
+    ):
+        self.max_concurrent_runs = max_concurrent_runs
+        self.max_concurrent_runs_per_channel = max_concurrent_runs_per_channel
+        self.max_queue_size = max_queue_size
+
+        self._running = 0
+        self._running_per_channel: Dict[str, int] = {}
+        # User -> their waiting jobs. Users are served round-robin in the
+        # order of this dict.
+        self._queues: 'OrderedDict[str, deque[_Job]]' = OrderedDict()
+        self._queue_size = 0
+
+    @property
+    def queue_size(self) -> int:
+        return self._queue_size
+
+    async def acquire(
+        self,
+        channel: str,
+        user: str,
+        on_queue_position: Union[Callable[[int], Any], None] = None,
+    ) -> _Job:
+        """
+        Waits until a run may start and returns a job that must be passed to
+        `release` once the run is done. `on_queue_position` is called with
+        the 1-based position in the queue whenever it changes.
+        """
+        job = _Job(channel, user, on_queue_position)
+
+        if not self._queue_size and self._can_start(job):
+            self._start(job)
+            return job
+
+        if self._queue_size >= self.max_queue_size:
+            raise RunQueueFullError(
+                f"too many pending requests ({self._queue_size} queued)")
+
+        job.started = asyncio.get_event_loop().create_future()
+        self._queues.setdefault(user, deque()).append(job)
+        self._queue_size += 1
+        self._dispatch()
+
+        try:
+            await job.started
+        except asyncio.CancelledError:
+            if job.running:
+                self.release(job)
+            else:
+                self._remove(job)
+                self._notify_queue_positions()
+            raise
+        return job
+
+    def release(self, job: _Job):
+        if not job.running:
+            return
+        job.running = False
+        self._running -= 1
+        self._running_per_channel[job.channel] -= 1
+        if not self._running_per_channel[job.channel]:
+            del self._running_per_channel[job.channel]
+        self._dispatch()
+
+    def _can_start(self, job: _Job) -> bool:
+        return (
+            self._running < self.max_concurrent_runs
+            and self._running_per_channel.get(job.channel, 0)
+            < self.max_concurrent_runs_per_channel
+        )
+
+    def _start(self, job: _Job):
+        job.running = True
+        self._running += 1
+        self._running_per_channel[job.channel] = \
+            self._running_per_channel.get(job.channel, 0) + 1
+        if job.started and not job.started.done():
+            job.started.set_result(None)
+
+    def _dispatch(self):
+        started_any = True
+        while started_any and self._running < self.max_concurrent_runs:
+            started_any = False
+            for user in list(self._queues.keys()):
+                # The user's oldest job whose channel has room.
+                job = next(
+                    (j for j in self._queues[user] if self._can_start(j)),
+                    None,
+                )
+                if job is None:
+                    continue
+                self._remove(job)
+                if user in self._queues:
+                    # Served, go to the back of the line.
+                    self._queues.move_to_end(user)
+                self._start(job)
+                started_any = True
+                break
+        self._notify_queue_positions()
+
+    def _remove(self, job: _Job):
+        queue = self._queues.get(job.user)
+        if queue is None or job not in queue:
+            return
+        queue.remove(job)
+        self._queue_size -= 1
+        if not queue:
+            del self._queues[job.user]
+
+    def _notify_queue_positions(self):
+        # The order in which jobs would start if no channel was at its cap.
+        order: List[_Job] = []
+        queues = list(self._queues.values())
+        for i in range(max((len(q) for q in queues), default=0)):
+            order += [q[i] for q in queues if i < len(q)]
+
+        for position, job in enumerate(order, start=1):
+            if job.queue_position == position:
+                continue
+            job.queue_position = position
+            if job.on_queue_position:
+                try:
+                    job.on_queue_position(position)
+                except Exception as e:
+                    logger.warning(f"Failed to report queue position: {e}")
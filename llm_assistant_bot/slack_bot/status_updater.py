@@ -0,0 +1,71 @@
+from typing import Any, Awaitable, Callable, Union
+
+import asyncio
+import logging
+
+logger = logging.getLogger("slack_status_updater")
+
+
+class StatusUpdater():
+    """
+    Sends status updates of a single message one at a time, in order, and
+    at most once every `interval` seconds. Statuses that come in while an
+    update is in flight or being throttled are coalesced, so only the latest
+    one is sent.
+    """
+
+    def __init__(
+        self,
+        send: Callable[[str], Awaitable[Any]],
+        interval: float,
+    ):
+        self._send = send
+        self.interval = interval
+
+        self._pending: Union[str, None] = None
+        self._has_pending: Union[asyncio.Event, None] = None
+        self._worker: Union[asyncio.Task, None] = None
+        self._closed = False
+
+    def update(self, status: str):
+        if self._closed:
+            return
+        self._pending = status
+        if self._has_pending is None:
+            self._has_pending = asyncio.Event()
+        self._has_pending.set()
+        if self._worker is None:
+            self._worker = asyncio.ensure_future(self._run())
+
+    async def close(self):
+        """
+        Drops any pending status and stops the worker. Should be awaited
+        before the message is replaced or deleted, so that no stale update
+        lands after it.
+        """
+        self._closed = True
+        self._pending = None
+        if self._worker is None:
+            return
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+
+    async def _run(self):
+        assert self._has_pending is not None
+        while True:
+            await self._has_pending.wait()
+            self._has_pending.clear()
+            status = self._pending
+            self._pending = None
+            if status is None:
+                continue
+
+            try:
+                await self._send(status)
+            except Exception as e:
+                logger.warning(f"Failed to update status: {e}")
+
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,243 @@
+from typing import Any, Dict, List, Tuple, Union
+
+import os
+import json
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+
+from slack_sdk.web.async_client import AsyncWebClient
+
+logger = logging.getLogger("slack_thread_cache")
+
+ThreadKey = Tuple[str, str]
+
+
+class _Thread():
+    def __init__(self, cursor: Union[str, None] = None):
+        self.messages: Dict[str, Dict[str, Any]] = {}
+        # The ts of the newest message fetched from the API. Messages after
+        # this are fetched on the next read, even if some of them have been
+        # seen in events already, so a missed event can not leave a gap.
+        self.cursor = cursor
+
+
+class ThreadCache():
+    """
+    Keeps the messages of recently active threads, so that building the
+    history of a thread only needs to fetch the messages that are newer than
+    what has been fetched before. Threads that are cached are also kept up
+    to date from the message events the bot receives.
+
+    Optionally, threads are also persisted to SQLite, so they survive
+    restarts. With `shared`, threads are always read from SQLite, so that
+    several processes can use the same cache.
+    """
+
+    def __init__(
+        self,
+        max_threads: int,
+        path: Union[str, None] = None,
+        shared: bool = False,
+    ):
+        if shared and not path:
+            raise ValueError('A shared thread cache needs a path.')
+        self.max_threads = max_threads
+        self.shared = shared
+        self._threads: 'OrderedDict[ThreadKey, _Thread]' = OrderedDict()
+
+        self._conn = None
+        self._lock = threading.Lock()
+        if path:
+            dir_path = os.path.dirname(path)
+            if dir_path:
+                os.makedirs(dir_path, exist_ok=True)
+            self._conn = sqlite3.connect(
+                path, check_same_thread=False, isolation_level=None)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS thread_messages (
+                    channel TEXT NOT NULL,
+                    thread_ts TEXT NOT NULL,
+                    ts TEXT NOT NULL,
+                    message TEXT NOT NULL,
+                    PRIMARY KEY (channel, thread_ts, ts)
+                )
+            ''')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS thread_cursors (
+                    channel TEXT NOT NULL,
+                    thread_ts TEXT NOT NULL,
+                    cursor TEXT NOT NULL,
+                    PRIMARY KEY (channel, thread_ts)
+                )
+            ''')
+
+    async def get_thread_messages(
+        self, client: AsyncWebClient, channel: str, thread_ts: str
+    ) -> List[Dict[str, Any]]:
+        """
+        Returns all messages of the thread in chronological order, fetching
+        only those newer than the cached cursor.
+        """
+        key = (channel, thread_ts)
+        thread = self._get_thread(key)
+        if thread is None:
+            thread = _Thread()
+            self._put_thread(key, thread)
+
+        fetched = []
+        next_cursor = None
+        while True:
+            kwargs: Dict[str, Any] = {
+                'channel': channel,
+                'ts': thread_ts,
+                'limit': 200,
+            }
+            if thread.cursor:
+                kwargs['oldest'] = thread.cursor
+            if next_cursor:
+                kwargs['cursor'] = next_cursor
+            response = await client.conversations_replies(**kwargs)
+            fetched += response.get('messages', [])
+
+            next_cursor = (
+                response.get('response_metadata') or {}
+            ).get('next_cursor')
+            if not response.get('has_more') or not next_cursor:
+                break
+
+        for message in fetched:
+            thread.messages[message['ts']] = message
+        if fetched:
+            newest_ts = max((m['ts'] for m in fetched), key=float)
+            if not thread.cursor or float(newest_ts) > float(thread.cursor):
+                thread.cursor = newest_ts
+        self._persist(key, fetched, thread.cursor)
+
+        logger.debug(
+            f"Thread {channel}/{thread_ts}: fetched {len(fetched)} message(s), "
+            f"{len(thread.messages)} cached.")
+
+        return sorted(thread.messages.values(), key=lambda m: float(m['ts']))
+
+    def handle_message_event(self, event: Dict[str, Any]):
+        """
+        Updates cached threads with a `message` event.
+        """
+        channel = event.get('channel')
+        if not channel:
+            return
+        subtype = event.get('subtype')
+
+        if subtype == 'message_deleted':
+            previous_message = event.get('previous_message') or {}
+            ts = event.get('deleted_ts') or previous_message.get('ts')
+            thread_ts = previous_message.get('thread_ts', ts)
+            if ts and thread_ts:
+                self._delete_message((channel, thread_ts), ts)
+            return
+
+        if subtype == 'message_changed':
+            message = event.get('message') or {}
+        else:
+            message = event
+
+        ts = message.get('ts')
+        if not ts:
+            return
+        thread_ts = message.get('thread_ts', ts)
+        self._update_message((channel, thread_ts), message)
+
+    def _get_thread(self, key: ThreadKey) -> Union[_Thread, None]:
+        # Other processes may have updated a shared thread.
+        if not self.shared:
+            thread = self._threads.get(key)
+            if thread is not None:
+                self._threads.move_to_end(key)
+                return thread
+
+        thread = self._load(key)
+        if thread is not None:
+            self._put_thread(key, thread)
+        return thread
+
+    def _put_thread(self, key: ThreadKey, thread: _Thread):
+        self._threads[key] = thread
+        self._threads.move_to_end(key)
+        while len(self._threads) > self.max_threads:
+            self._threads.popitem(last=False)
+
+    def _update_message(self, key: ThreadKey, message: Dict[str, Any]):
+        # Only threads that have been read are tracked, other messages are
+        # of no interest to the bot.
+        thread = self._get_thread(key)
+        if thread is None:
+            return
+        message = {k: v for k, v in message.items() if k != 'channel'}
+        thread.messages[message['ts']] = message
+        self._persist(key, [message], None)
+
+    def _delete_message(self, key: ThreadKey, ts: str):
+        thread = self._get_thread(key)
+        if thread is None:
+            return
+        thread.messages.pop(ts, None)
+        if self._conn is not None:
+            with self._lock:
+                self._conn.execute(
+                    'DELETE FROM thread_messages '
+                    'WHERE channel = ? AND thread_ts = ? AND ts = ?',
+                    (key[0], key[1], ts),
+                )
+
+    def _load(self, key: ThreadKey) -> Union[_Thread, None]:
+        if self._conn is None:
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT cursor FROM thread_cursors '
+                'WHERE channel = ? AND thread_ts = ?',
+                key,
+            ).fetchone()
+            if row is None:
+                return None
+            thread = _Thread(cursor=row[0])
+            for ts, message in self._conn.execute(
+                'SELECT ts, message FROM thread_messages '
+                'WHERE channel = ? AND thread_ts = ?',
+                key,
+            ):
+                thread.messages[ts] = json.loads(message)
+        return thread
+
+    def _persist(
+        self,
+        key: ThreadKey,
+        messages: List[Dict[str, Any]],
+        cursor: Union[str, None],
+    ):
+        if self._conn is None:
+            return
+        with self._lock:
+            self._conn.execute('BEGIN')
+            try:
+                self._conn.executemany(
+                    'INSERT OR REPLACE INTO thread_messages '
+                    '(channel, thread_ts, ts, message) VALUES (?, ?, ?, ?)',
+                    [
+                        (key[0], key[1], m['ts'], json.dumps(m))
+                        for m in messages
+                    ],
+                )
+                if cursor:
+                    self._conn.execute(
+                        'INSERT OR REPLACE INTO thread_cursors '
+                        '(channel, thread_ts, cursor) VALUES (?, ?, ?)',
+                        (key[0], key[1], cursor),
+                    )
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
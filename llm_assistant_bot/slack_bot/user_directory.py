@@ -0,0 +1,87 @@
+from typing import Any, Dict, Iterable, Tuple, Union
+
+import time
+import asyncio
+import logging
+
+from slack_sdk.web.async_client import AsyncWebClient
+
+from ..config import Config
+
+logger = logging.getLogger("slack_user_directory")
+
+
+class UserDirectory():
+    """
+    App-level cache of Slack user profiles. Entries expire after `ttl`
+    seconds, concurrent lookups of the same user share a single `users.info`
+    call, and the whole workspace can be loaded up front with `users.list`.
+    """
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+        self._users: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+        self._pending: Dict[str, asyncio.Future] = {}
+
+    async def get_user(
+        self, client: AsyncWebClient, user_id: str
+    ) -> Dict[str, Any]:
+        cached = self._users.get(user_id)
+        if cached is not None and time.time() - cached[0] < self.ttl:
+            return cached[1]
+
+        pending = self._pending.get(user_id)
+        if pending is None:
+            pending = asyncio.ensure_future(self._fetch_user(client, user_id))
+            self._pending[user_id] = pending
+            pending.add_done_callback(
+                lambda _: self._pending.pop(user_id, None))
+        # Shielded so that a cancelled caller does not cancel the lookup
+        # other callers are waiting for.
+        return await asyncio.shield(pending)
+
+    async def get_users(
+        self, client: AsyncWebClient, user_ids: Iterable[str]
+    ) -> Dict[str, Dict[str, Any]]:
+        user_ids = list(dict.fromkeys(user_ids))
+        users = await asyncio.gather(
+            *(self.get_user(client, user_id) for user_id in user_ids)
+        )
+        return dict(zip(user_ids, users))
+
+    async def warm_up(self, client: AsyncWebClient):
+        count = 0
+        cursor: Union[str, None] = None
+        while True:
+            kwargs: Dict[str, Any] = {'limit': 200}
+            if cursor:
+                kwargs['cursor'] = cursor
+            response = await client.users_list(**kwargs)
+            now = time.time()
+            for user in response.get('members', []):
+                self._users[user['id']] = (now, user)
+                count += 1
+            cursor = (
+                response.get('response_metadata') or {}
+            ).get('next_cursor')
+            if not cursor:
+                break
+        logger.info(f"Loaded {count} user(s) into the user directory.")
+
+    async def _fetch_user(
+        self, client: AsyncWebClient, user_id: str
+    ) -> Dict[str, Any]:
+        response = await client.users_info(user=user_id)
+        user = response['user']
+        self._users[user_id] = (time.time(), user)
+        return user
+
+
+_user_directory: Union[UserDirectory, None] = None
+
+
+def get_user_directory() -> UserDirectory:
+    global _user_directory
+    if _user_directory is None:
+        _user_directory = UserDirectory(ttl=Config.slack.user_cache_ttl)
+    return _user_directory
@@ -0,0 +1,86 @@
+from typing import Any, Callable, List
+
+import time
+import signal
+import socket
+import logging
+import multiprocessing
+
+from ..db.chroma_server import (
+    start_chroma_server,
+    stop_chroma_server,
+    connect_chroma_server,
+)
+
+logger = logging.getLogger("slack_bot_workers")
+
+
+def _run_worker(
+    run_web_app: Callable[[socket.socket], Any],
+    sock: socket.socket,
+    chroma_address: Any,
+):
+    connect_chroma_server(chroma_address)
+    run_web_app(sock)
+
+
+def run_workers(
+    num_workers: int,
+    host: str,
+    port: int,
+    run_web_app: Callable[[socket.socket], Any],
+):
+    """
+    Runs `run_web_app` in `num_workers` processes that accept connections
+    from one shared listening socket. The vector store is owned by a
+    separate process that the workers talk to. Workers that die are
+    restarted.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(128)
+    sock.set_inheritable(True)
+
+    chroma_manager = start_chroma_server()
+    ctx = multiprocessing.get_context('fork')
+
+    def start_worker(i: int):
+        process = ctx.Process(
+            target=_run_worker,
+            args=(run_web_app, sock, chroma_manager.address),
+            name=f'slack-bot-worker-{i}',
+        )
+        process.start()
+        logger.info(f"Started worker {i} (pid {process.pid}).")
+        return process
+
+    def handle_sigterm(signum, frame):
+        raise KeyboardInterrupt()
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
+    workers: List[Any] = [start_worker(i) for i in range(num_workers)]
+    logger.info(
+        f"Running on http://{host}:{port} with {num_workers} workers.")
+    try:
+        while True:
+            time.sleep(1)
+            for i, process in enumerate(workers):
+                if not process.is_alive():
+                    logger.error(
+                        f"Worker {i} exited with code {process.exitcode}, "
+                        "restarting it.")
+                    workers[i] = start_worker(i)
+    except KeyboardInterrupt:
+        logger.info("Stopping workers...")
+    finally:
+        for process in workers:
+            if process.is_alive():
+                process.terminate()
+        for process in workers:
+            process.join(timeout=30)
+            if process.is_alive():
+                process.kill()
+        stop_chroma_server(chroma_manager)
+        sock.close()
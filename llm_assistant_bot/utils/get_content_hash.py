@@ -0,0 +1,10 @@
+import json
+import hashlib
+
+
+def get_content_hash(*parts):
+    serialized = json.dumps(parts, sort_keys=True, ensure_ascii=False,
+                            default=str)
+    hash_object = hashlib.sha256(serialized.encode('utf-8'))
+    hex_dig = hash_object.hexdigest()
+    return hex_dig
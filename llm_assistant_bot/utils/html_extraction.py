@@ -0,0 +1,83 @@
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from lxml import etree
+from lxml import html as lxml_html
+from readability import Document
+from markdownify import markdownify
+
+# These functions are run in the extraction worker processes (see
+# `agent/tools/extraction_pool.py`).
+
+
+def extract_readable_content(html: str) -> Tuple[str, str]:
+    """
+    Returns the title and the main content of the page, as Markdown.
+    """
+    doc = Document(html)
+    return doc.title(), markdownify(doc.summary())
+
+
+# How far up from a result link to look for the element that contains the
+# whole result.
+GOOGLE_RESULT_MAX_DEPTH = 8
+
+
+def parse_google_search_results(
+    html: str,
+) -> Union[List[Tuple[str, str, Optional[str]]], None]:
+    """
+    Returns `(title, url, description)` of each result on a Google search
+    results page, or None if the page can not be parsed.
+    """
+    try:
+        tree = lxml_html.fromstring(html)
+    except ValueError:
+        # Strings with an XML encoding declaration have to be parsed as
+        # bytes.
+        tree = lxml_html.fromstring(html.encode('utf-8'))
+    except etree.ParserError:
+        return None
+
+    search_results_element = tree.get_element_by_id('search', None)
+    if search_results_element is None:
+        return None
+
+    descriptions: Dict[Any, Optional[str]] = {}
+
+    def find_description(elem):
+        # The result container is the closest ancestor with a `lang`
+        # attribute, within a bounded number of levels.
+        container_elem = None
+        parent_elem = elem.getparent()
+        for _ in range(GOOGLE_RESULT_MAX_DEPTH):
+            if parent_elem is None or parent_elem is search_results_element:
+                break
+            if parent_elem.get('lang') is not None:
+                container_elem = parent_elem
+                break
+            parent_elem = parent_elem.getparent()
+        if container_elem is None:
+            return None
+
+        # Several links can share a container.
+        if container_elem not in descriptions:
+            descriptions[container_elem] = None
+            for description_elem in container_elem.iterfind('.//*[@data-sncf]'):
+                if description_elem.get('data-sncf').strip().startswith('1'):
+                    descriptions[container_elem] = \
+                        description_elem.text_content().strip()
+                    break
+        return descriptions[container_elem]
+
+    results = []
+    for elem in search_results_element.iterfind('.//*[@href]'):
+        href = elem.get('href')
+        if (
+            not href.startswith('http')
+            or href.startswith('https://www.google.com/search')
+            or href.startswith('https://translate.google.com')
+        ):
+            continue
+        title = ' '.join(elem.text_content().split())
+        results.append((title, href, find_description(elem)))
+    return results
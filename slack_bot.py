@@ -1,23 +1,78 @@
 from typing import Optional
 
+import socket
+import logging
+
 import fire
+from aiohttp import web
 
 from llm_assistant_bot.initialization import initialize
 from llm_assistant_bot.config import Config
 from llm_assistant_bot.slack_bot import get_slack_bot_app
+from llm_assistant_bot.slack_bot.user_directory import get_user_directory
+from llm_assistant_bot.slack_bot.job_queue import get_job_queue
+from llm_assistant_bot.slack_bot.workers import run_workers
+from llm_assistant_bot.agent.tools.browser_manager import get_browser_manager
+from llm_assistant_bot.agent.tools.extraction_pool import get_extraction_pool
+from llm_assistant_bot.agent.tools.http_fetcher import get_http_fetcher
+from llm_assistant_bot.db import flush as flush_db
 
 import nest_asyncio
 nest_asyncio.apply()
 
+logger = logging.getLogger("slack_bot")
 
-def main(config_path: Optional[str] = None):
-    initialize(config_path=config_path)
 
+async def on_startup(web_app: web.Application):
+    # Launch the browser before the first message arrives, since it is the
+    # slowest thing to start.
+    await get_browser_manager().start()
+
+    if Config.slack.user_cache_warm_up:
+        try:
+            await get_user_directory().warm_up(web_app['slack_bot_app'].client)
+        except Exception as e:
+            logger.warning(f"Failed to warm up the user directory: {e}")
+
+
+async def on_cleanup(web_app: web.Application):
+    await get_job_queue().close()
+    await get_browser_manager().close()
+    get_extraction_pool().close()
+    await get_http_fetcher().close()
+    flush_db()
+
+
+def run_web_app(sock: Optional[socket.socket] = None):
     slack_bot_app = get_slack_bot_app()
-    slack_bot_app.start(
-        host=Config.slack.bot_host,
-        port=Config.slack.bot_port,
-    )
+    web_app = slack_bot_app.web_app(port=Config.slack.bot_port)
+    web_app['slack_bot_app'] = slack_bot_app
+    web_app.on_startup.append(on_startup)
+    web_app.on_cleanup.append(on_cleanup)
+    if sock is not None:
+        web.run_app(web_app, sock=sock)
+    else:
+        web.run_app(
+            web_app,
+            host=Config.slack.bot_host,
+            port=Config.slack.bot_port,
+        )
+
+
+def main(config_path: Optional[str] = None, workers: Optional[int] = None):
+    initialize(config_path=config_path)
+    if workers is not None:
+        Config.slack.workers = workers
+
+    if Config.slack.workers > 1:
+        run_workers(
+            Config.slack.workers,
+            host=Config.slack.bot_host,
+            port=Config.slack.bot_port,
+            run_web_app=run_web_app,
+        )
+    else:
+        run_web_app()
 
 
 if __name__ == "__main__":